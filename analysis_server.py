@@ -0,0 +1,301 @@
+# Analysis Server
+# Long running local service that keeps a warm worker pool and results cache
+# so scripts do not pay the import and worker start up cost on every analysis
+# Max Jantos
+#
+# Protocol: one JSON object per line in, one JSON object per line out
+#   {"cmd": "analyze_file", "filename": ..., "maxthresh": 17500}
+#   {"cmd": "analyze_plate", "dirname": ..., "pattern": 0, "site": 5, "maxthresh": 17500, "wait": false}
+#   {"cmd": "status"}  or  {"cmd": "status", "job": <id>}
+#   {"cmd": "result", "job": <id>}
+# Every request may carry a "client" name; work is shared fairly between clients
+#
+# Run from the command line:
+#   python analysis_server.py --socket /tmp/cell-analysis.sock
+#   python analysis_server.py --port 8765
+
+import json
+import socket
+import argparse
+import threading
+import socketserver
+from os import path, listdir, stat, remove, cpu_count
+from itertools import count as counter
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from nuclei_detection import get_filenames, ndimage, tf
+from batch_jobs import analyze_well
+
+
+# ******************************************************************************
+# Worker side
+# ******************************************************************************
+
+# Pool initializer: scipy.ndimage and tifffile are imported lazily (see lazy_import.py),
+# touching them here loads them when the worker starts instead of on its first request
+def warm_worker():
+    ndimage.convolve
+    tf.TiffFile
+
+# Analyze a batch of (filename, maxthresh) pairs in one worker call
+# batching keeps the pickling round trips down for plates with many small images
+def analyze_batch(tasks):
+    results = []
+    for filename, maxthresh in tasks:
+        try:
+            results.append(analyze_well(filename, maxthresh))
+        except Exception:
+            results.append(None)
+    return results
+
+
+# ******************************************************************************
+# Jobs and scheduling
+# ******************************************************************************
+
+# One "analyze file" or "analyze plate" request
+class Job:
+    def __init__(self, job_id, client, file_d, total_files):
+        self.id = job_id
+        self.client = client
+        self.file_d = file_d            # well tag with site : image's filepath
+        self.nucpts_d = {}              # well tag with site : list of nucpt coordinates (None if it failed)
+        self.total_files = total_files
+        self.remaining = len(file_d)
+        self.finished = threading.Event()
+        if self.remaining == 0: self.finished.set()
+
+    def status(self):
+        total = len(self.file_d)
+        return {"job": self.id, "done": total - self.remaining, "total": total,
+                "finished": self.finished.is_set()}
+
+    # same layout multi_file_analysis returns, with numpy arrays turned into lists
+    def result(self):
+        nucpts_d = {w: (None if pts is None else pts.tolist()) for w, pts in self.nucpts_d.items()}
+        nucCounts_d = {w: (0 if pts is None else len(pts)) for w, pts in self.nucpts_d.items()}
+        return {"job": self.id, "file_d": self.file_d, "nucpts_d": nucpts_d,
+                "nucCounts_d": nucCounts_d, "total_files": self.total_files}
+
+
+class AnalysisService:
+    def __init__(self, max_workers=None, batch_size=4, cache_size=4096):
+        self.max_workers = max_workers or cpu_count() or 1
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+
+        self.pool = ProcessPoolExecutor(max_workers=self.max_workers, initializer=warm_worker)
+        # start (and warm) every worker now instead of on the first requests
+        self.warmup = [self.pool.submit(analyze_batch, []) for _ in range(self.max_workers)]
+        # at most two batches per worker are handed to the pool at a time,
+        # everything else waits in the per client queues so new clients are not stuck behind old ones
+        self.slots = threading.Semaphore(2 * self.max_workers)
+
+        self.lock = threading.Condition()
+        self.queues = OrderedDict()     # client : deque of (job, well, cache key) waiting for a worker
+        self.cache = OrderedDict()      # (filename, mtime, maxthresh) : nucpts, least recently used first
+        self.jobs = {}                  # job id : Job
+        self.job_ids = counter(1)
+        self.running = True
+
+        self.scheduler = threading.Thread(target=self.schedule, daemon=True)
+        self.scheduler.start()
+
+    def shutdown(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        self.pool.shutdown(cancel_futures=True)
+
+    # results cache key, changes whenever the file is rewritten
+    def cache_key(self, filename, maxthresh):
+        return (filename, stat(filename).st_mtime_ns, maxthresh)
+
+    # Queue the wells of file_d for the given client, wells already in the cache finish right away
+    def submit(self, client, file_d, maxthresh, total_files):
+        with self.lock:
+            job = Job(next(self.job_ids), client, file_d, total_files)
+            self.jobs[job.id] = job
+            queue = self.queues.get(client, deque())
+            for well, filename in file_d.items():
+                key = self.cache_key(filename, maxthresh)
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    self.complete(job, well, self.cache[key])
+                else:
+                    queue.append((job, well, key))
+            if queue and client not in self.queues:
+                self.queues[client] = queue
+            self.lock.notify_all()
+        return job
+
+    # Take up to batch_size wells, one per client in turn (round robin)
+    # must hold self.lock
+    def next_batch(self):
+        batch = []
+        while len(batch) < self.batch_size and self.queues:
+            client, queue = self.queues.popitem(last=False)
+            batch.append(queue.popleft())
+            if queue: self.queues[client] = queue # back of the line
+        return batch
+
+    # Scheduler thread: feeds batches to the pool whenever a slot is free
+    def schedule(self):
+        while True:
+            self.slots.acquire()
+            with self.lock:
+                while self.running and not self.queues:
+                    self.lock.wait()
+                if not self.running: return
+                batch = self.next_batch()
+            tasks = [(key[0], key[2]) for (_, _, key) in batch]
+            future = self.pool.submit(analyze_batch, tasks)
+            future.add_done_callback(lambda f, batch=batch: self.finish_batch(batch, f))
+
+    def finish_batch(self, batch, future):
+        self.slots.release()
+        results = [None] * len(batch) if future.cancelled() or future.exception() else future.result()
+        with self.lock:
+            for (job, well, key), nucpts in zip(batch, results):
+                if nucpts is not None:
+                    self.cache[key] = nucpts
+                    if len(self.cache) > self.cache_size: self.cache.popitem(last=False)
+                self.complete(job, well, nucpts)
+
+    # must hold self.lock
+    def complete(self, job, well, nucpts):
+        job.nucpts_d[well] = nucpts
+        job.remaining -= 1
+        if job.remaining == 0: job.finished.set()
+
+    # **************************************************************************
+    # Requests
+    # **************************************************************************
+
+    def handle_request(self, request, default_client):
+        cmd = request.get("cmd")
+        client = request.get("client", default_client)
+        maxthresh = request.get("maxthresh", 17500)
+
+        if cmd == "analyze_file":
+            filename = request.get("filename", "")
+            if not path.isfile(filename): return {"error": f"No such file: {filename}"}
+            job = self.submit(client, {filename: filename}, maxthresh, 1)
+            if not request.get("wait", True): return job.status()
+            job.finished.wait()
+            nucpts = self.pop_job(job.id).nucpts_d[filename]
+            if nucpts is None: return {"job": job.id, "error": f"Analysis failed for {filename}"}
+            return {"job": job.id, "filename": filename, "nucpts": nucpts.tolist(), "count": len(nucpts)}
+
+        if cmd == "analyze_plate":
+            dirname = request.get("dirname", "")
+            if not path.isdir(dirname): return {"error": f"No such directory: {dirname}"}
+            total_files = len([f for f in listdir(dirname) if path.isfile(path.join(dirname, f))])
+            file_d = get_filenames(dirname, request.get("pattern", 0), request.get("site", 5))
+            if len(file_d) == 0: return {"error": "No files that match the selected search parameters"}
+            job = self.submit(client, file_d, maxthresh, total_files)
+            if not request.get("wait", False): return job.status()
+            job.finished.wait()
+            return self.pop_job(job.id).result()
+
+        if cmd == "status":
+            if "job" in request:
+                job = self.jobs.get(request["job"])
+                return job.status() if job else {"error": f"Unknown job {request['job']}"}
+            with self.lock:
+                queued = sum(len(q) for q in self.queues.values())
+                return {"workers": self.max_workers, "jobs": len(self.jobs), "queued": queued,
+                        "clients_waiting": len(self.queues), "cache_entries": len(self.cache)}
+
+        if cmd == "result":
+            job = self.jobs.get(request.get("job"))
+            if job is None: return {"error": f"Unknown job {request.get('job')}"}
+            if not job.finished.is_set(): return job.status()
+            return self.pop_job(job.id).result()
+
+        return {"error": f"Unknown command: {cmd}"}
+
+    # finished jobs are dropped once their result has been handed out
+    def pop_job(self, job_id):
+        with self.lock:
+            return self.jobs.pop(job_id)
+
+
+# ******************************************************************************
+# Socket servers
+# ******************************************************************************
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # connections without a client name are each treated as their own client
+        default_client = f"connection {id(self)}"
+        for line in self.rfile:
+            if not line.strip(): continue
+            try:
+                response = self.server.service.handle_request(json.loads(line), default_client)
+            except Exception as e:
+                response = {"error": str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode('UTF8'))
+
+
+class TCPAnalysisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, service):
+        super().__init__(("127.0.0.1", port), RequestHandler)
+        self.service = service
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class UnixAnalysisServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, socket_path, service):
+            super().__init__(socket_path, RequestHandler)
+            self.service = service
+
+
+# Send one request to a running server and return its response
+# address is a socket path (str) or a localhost port (int)
+def send_request(address, request):
+    if isinstance(address, int):
+        sock = socket.create_connection(("127.0.0.1", address))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    with sock, sock.makefile('rwb') as f:
+        f.write((json.dumps(request) + "\n").encode('UTF8'))
+        f.flush()
+        return json.loads(f.readline())
+
+
+# ******************************************************************************
+# Main
+# ******************************************************************************
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a warm local nuclei analysis server")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--socket", help="unix socket path to listen on")
+    group.add_argument("--port", type=int, help="localhost TCP port to listen on")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=4, help="images handed to a worker at a time")
+    parser.add_argument("--cache-size", type=int, default=4096, help="images kept in the results cache")
+    args = parser.parse_args()
+
+    service = AnalysisService(args.workers, args.batch_size, args.cache_size)
+    if args.socket:
+        if path.exists(args.socket): remove(args.socket)
+        server = UnixAnalysisServer(args.socket, service)
+    else:
+        server = TCPAnalysisServer(args.port, service)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+        if args.socket and path.exists(args.socket): remove(args.socket)
@@ -0,0 +1,286 @@
+# Batch Job Queue
+# Runs the nuclei analysis over many plate directories, checkpointing each well
+# so that an interrupted batch can be resumed where it stopped
+# Max Jantos
+#
+# Layout of a batch directory:
+#   manifest.json   - settings, plates and their wells (written when the batch is created)
+#   progress.jsonl  - one line appended per finished well, replayed on top of the manifest
+#   plateNNN_<dir>/ - one checkpoint file per well (C17_s5.npy holds that well's nucpts)
+#
+# Run from the command line:
+#   python batch_jobs.py <batch dir> <plate dir> [<plate dir> ...] --pattern 0 --site 5 [--store results.db]
+
+import json
+import argparse
+from os import path, listdir, makedirs, replace, cpu_count, fsync
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from nuclei_detection import get_img, normalize_img, get_nuc_centers, get_filenames
+from projection import project_stack
+from results_store import ResultsStore
+
+
+MANIFEST_NAME = "manifest.json"
+PROGRESS_NAME = "progress.jsonl"
+
+
+# ******************************************************************************
+# Manifest
+# ******************************************************************************
+
+# name of the checkpoint file for a well ("C17 s5" -> "C17_s5.npy")
+def checkpoint_name(well):
+    return well.replace(' ', '_') + ".npy"
+
+# name of the checkpoint directory for the i-th plate of a batch
+def plate_tag(i, dirname):
+    return f"plate{i:03d}_{path.basename(path.normpath(dirname))}"
+
+# Build a new manifest for the given plate directories
+# every matching well starts out as "pending"
+def new_manifest(plate_dirs, pattern, site, maxthresh):
+    plates = []
+    for i, dirname in enumerate(plate_dirs):
+        plate = {"dirname": dirname, "tag": plate_tag(i, dirname), "total_files": 0, "error": None, "wells": {}}
+        try:
+            plate["total_files"] = len([f for f in listdir(dirname) if path.isfile(path.join(dirname, f))])
+            file_d = get_filenames(dirname, pattern, site)
+        except OSError as e:
+            plate["error"] = str(e)
+            file_d = {}
+        plate["wells"] = {well: {"file": filename, "status": "pending", "count": None}
+                          for well, filename in sorted(file_d.items())}
+        plates.append(plate)
+
+    settings = {"pattern": pattern, "site": site, "maxthresh": maxthresh}
+    return {"settings": settings, "plates": plates}
+
+# write a file without ever leaving a half written copy behind
+def atomic_write_json(filepath, data):
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, 'w', encoding='UTF8') as f:
+        json.dump(data, f, indent=1)
+        f.flush()
+        fsync(f.fileno())
+    replace(tmp_path, filepath)
+
+# Load the manifest of a batch directory with the progress log applied
+# returns None if the directory does not hold a batch yet
+def load_manifest(batch_dir):
+    manifest_path = path.join(batch_dir, MANIFEST_NAME)
+    if not path.isfile(manifest_path): return None
+    with open(manifest_path, encoding='UTF8') as f:
+        manifest = json.load(f)
+
+    progress_path = path.join(batch_dir, PROGRESS_NAME)
+    if path.isfile(progress_path):
+        with open(progress_path, encoding='UTF8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line may be cut short if the batch was killed while writing it
+                    continue
+                well = manifest["plates"][entry["plate"]]["wells"][entry["well"]]
+                well["status"] = entry["status"]
+                well["count"] = entry["count"]
+    return manifest
+
+# Fold the progress log into the manifest so the log does not grow forever
+def compact_manifest(batch_dir, manifest):
+    atomic_write_json(path.join(batch_dir, MANIFEST_NAME), manifest)
+    open(path.join(batch_dir, PROGRESS_NAME), 'w').close()
+
+# Append one finished well to the progress log
+def record_progress(log, plate_i, well, status, count):
+    log.write(json.dumps({"plate": plate_i, "well": well, "status": status, "count": count}) + "\n")
+    log.flush()
+    fsync(log.fileno())
+
+# Save a well's nucpts next to the manifest
+def write_checkpoint(batch_dir, plate, well, nucpts):
+    plate_dir = path.join(batch_dir, plate["tag"])
+    filepath = path.join(plate_dir, checkpoint_name(well))
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, nucpts)
+        f.flush()
+        fsync(f.fileno())
+    replace(tmp_path, filepath)
+
+
+# ******************************************************************************
+# Running a batch
+# ******************************************************************************
+
+# Worker side of the queue: analyze the image of one well
+# each worker reads its own file so disk reads are spread across the workers too
+def analyze_well(filename, maxthresh):
+    img = get_img(filename, maxthresh)
+    return get_nuc_centers(img)
+
+# analyze_well that also returns the raw maximum and total intensity of the image
+# an image that can't be read is a failed well like one detection fails on, (None, None, None),
+# so any exception the future raises comes from the pool itself
+def analyze_well_stats(filename, maxthresh):
+    try:
+        projs = project_stack(filename, ("sum", "max"))
+    except Exception:
+        return (None, None, None)
+    nucpts = get_nuc_centers(normalize_img(projs["max"], maxthresh))
+    return (nucpts, projs["max"].max(), float(np.sum(projs["sum"])))
+
+# Returns (plate index, well) pairs for every well that still needs to run
+# plates are queued in the order they were given so early plates finish first
+def pending_wells(manifest, retry_failed=False):
+    todo = ("pending", "failed") if retry_failed else ("pending",)
+    return [(plate_i, well) for plate_i, plate in enumerate(manifest["plates"])
+                            for well, info in plate["wells"].items() if info["status"] in todo]
+
+# Create or resume the batch stored in batch_dir
+# plate_dirs and the settings must match the manifest when resuming an existing batch
+# progress(done, total) is called after every finished well
+# store_path: optional results store (see results_store.py) each finished well is also written to
+# returns the final manifest
+def run_batch(batch_dir, plate_dirs, pattern=0, maxthresh=17500, site=5,
+              max_workers=None, retry_failed=False, progress=None, store_path=None):
+    makedirs(batch_dir, exist_ok=True)
+    manifest = load_manifest(batch_dir)
+    if manifest is None:
+        manifest = new_manifest(plate_dirs, pattern, site, maxthresh)
+        atomic_write_json(path.join(batch_dir, MANIFEST_NAME), manifest)
+    else:
+        settings = {"pattern": pattern, "site": site, "maxthresh": maxthresh}
+        if manifest["settings"] != settings:
+            raise ValueError(f"Batch in {batch_dir} was created with different settings: {manifest['settings']}")
+        if [p["dirname"] for p in manifest["plates"]] != list(plate_dirs):
+            raise ValueError(f"Batch in {batch_dir} was created for a different list of plates")
+
+    for plate in manifest["plates"]:
+        makedirs(path.join(batch_dir, plate["tag"]), exist_ok=True)
+
+    store = None
+    if store_path is not None:
+        store = ResultsStore(store_path)
+        # plates are added to the store once, the id is kept in the manifest for resumed runs
+        for plate in manifest["plates"]:
+            if plate.get("store_id") is None and plate["error"] is None:
+                plate["store_id"] = store.add_plate(plate["dirname"], pattern, site, maxthresh,
+                                                    total_files=plate["total_files"])
+        atomic_write_json(path.join(batch_dir, MANIFEST_NAME), manifest)
+
+    todo = pending_wells(manifest, retry_failed)
+    total = sum(len(p["wells"]) for p in manifest["plates"])
+    done = total - len(todo)
+    if progress: progress(done, total)
+    if len(todo) == 0:
+        compact_manifest(batch_dir, manifest)
+        if store: store.close()
+        return manifest
+
+    if max_workers is None: max_workers = cpu_count() or 1
+    # keep a couple of wells queued per worker so no worker waits on the main process,
+    # without holding the whole batch's futures (and results) in memory at once
+    window = 2 * max_workers
+    todo_iter = iter(todo)
+
+    with open(path.join(batch_dir, PROGRESS_NAME), 'a', encoding='UTF8') as log, \
+         ProcessPoolExecutor(max_workers=max_workers) as pool:
+        running = {}
+
+        def submit_next():
+            for plate_i, well in todo_iter:
+                filename = manifest["plates"][plate_i]["wells"][well]["file"]
+                running[pool.submit(analyze_well_stats, filename, maxthresh)] = (plate_i, well)
+                return True
+            return False
+
+        for _ in range(window):
+            if not submit_next(): break
+
+        error = None
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                plate_i, well = running.pop(future)
+                if future.exception() is not None:
+                    # broken pool (a worker was killed) or an interrupt, not a problem with the well:
+                    # it stays pending so the next run picks it up again
+                    if error is None: error = future.exception()
+                    continue
+                plate = manifest["plates"][plate_i]
+                (nucpts, max_value, sum_value) = future.result()
+                if nucpts is None:
+                    status, count = "failed", None
+                else:
+                    write_checkpoint(batch_dir, plate, well, nucpts)
+                    if store:
+                        store.add_well(plate["store_id"], [(well, plate["wells"][well]["file"], nucpts,
+                                                            max_value, sum_value)])
+                    status, count = "done", len(nucpts)
+                plate["wells"][well]["status"] = status
+                plate["wells"][well]["count"] = count
+                record_progress(log, plate_i, well, status, count)
+
+                done += 1
+                if progress: progress(done, total)
+                if error is None: submit_next()
+        if error is not None: raise error
+
+    compact_manifest(batch_dir, manifest)
+    if store: store.close()
+    return manifest
+
+
+# ******************************************************************************
+# Reading results
+# ******************************************************************************
+
+# Load the finished wells of every plate in a batch
+# returns a list of (dirname, (file_d, nucpts_d, nucCounts_d, total_files)),
+# the first four entries of the tuple multi_file_analysis returns for a single plate
+def load_batch_results(batch_dir):
+    manifest = load_manifest(batch_dir)
+    if manifest is None: return []
+    results = []
+    for plate in manifest["plates"]:
+        file_d, nucpts_d, nucCounts_d = {}, {}, {}
+        for well, info in plate["wells"].items():
+            if info["status"] != "done": continue
+            file_d[well] = info["file"]
+            nucpts_d[well] = np.load(path.join(batch_dir, plate["tag"], checkpoint_name(well)))
+            nucCounts_d[well] = info["count"]
+        results.append((plate["dirname"], (file_d, nucpts_d, nucCounts_d, plate["total_files"])))
+    return results
+
+
+# ******************************************************************************
+# Main
+# ******************************************************************************
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run or resume a multi-plate nuclei analysis batch")
+    parser.add_argument("batch_dir", help="directory holding the manifest and checkpoints")
+    parser.add_argument("plate_dirs", nargs="+", help="plate image directories, in the order to process them")
+    parser.add_argument("--pattern", type=int, default=0, help="0 = every well, 1 = every other well, 2 = 1/4 wells")
+    parser.add_argument("--site", type=int, default=5)
+    parser.add_argument("--maxthresh", type=int, default=17500)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--retry-failed", action="store_true", help="rerun wells that failed on an earlier run")
+    parser.add_argument("--store", default=None, help="results store database to also write each well to")
+    args = parser.parse_args()
+
+    def print_progress(done, total):
+        print(f"\r{done} / {total} wells analyzed", end="", flush=True)
+
+    manifest = run_batch(args.batch_dir, args.plate_dirs, args.pattern, args.maxthresh, args.site,
+                         args.workers, args.retry_failed, print_progress, args.store)
+    print()
+    for plate in manifest["plates"]:
+        failed = [w for w, info in plate["wells"].items() if info["status"] == "failed"]
+        if plate["error"]:
+            print(f"{plate['dirname']}: {plate['error']}")
+        elif failed:
+            print(f"{plate['dirname']}: {len(failed)} well(s) failed: {', '.join(failed)}")
@@ -0,0 +1,77 @@
+# Startup Benchmark
+# Times cold imports of the gui and analysis modules in fresh interpreters,
+# and the first use of the lazily loaded modules
+# Max Jantos
+#
+# Run from the command line:
+#   python benchmark_startup.py [--runs 5]
+
+import sys
+import argparse
+import subprocess
+from os import path
+from statistics import median
+
+
+HERE = path.dirname(path.abspath(__file__))
+
+# one tiny image analyzed by a server whose workers have finished starting up
+WARM_SERVER_SETUP = """
+import atexit, tempfile, numpy as np, tifffile
+from os import path
+from analysis_server import AnalysisService
+filename = path.join(tempfile.mkdtemp(), "bench.tif")
+tifffile.imwrite(filename, np.random.default_rng(0).integers(0, 20000, (256, 256), dtype=np.uint16))
+service = AnalysisService(max_workers=1)
+atexit.register(service.shutdown)
+for future in service.warmup: future.result()
+"""
+
+# name : code run in a fresh interpreter, timed from just before to just after
+#        or (setup, code) when only code is timed
+CASES = {
+    "import gui": "import gui",
+    "import nuclei_detection": "import nuclei_detection",
+    "import batch_jobs": "import batch_jobs",
+    "first detect_nuclei": "import numpy as np, nuclei_detection; nuclei_detection.detect_nuclei(np.zeros((64, 64)))",
+    "eager heavy imports": "import scipy.ndimage, tifffile, matplotlib.pyplot",
+    # what import gui no longer pays for, matplotlib is imported when the first image is shown
+    "gui then first figure import": "import gui, matplotlib.pyplot",
+    "warm server request": (WARM_SERVER_SETUP, 'service.handle_request({"cmd": "analyze_file", "filename": filename}, "bench")'),
+}
+
+TIMER = """
+{setup}
+import time
+t0 = time.perf_counter()
+{code}
+print(time.perf_counter() - t0)
+"""
+
+
+# time one case in a new interpreter so nothing is cached in sys.modules
+def time_case(code):
+    (setup, code) = code if isinstance(code, tuple) else ("", code)
+    out = subprocess.run([sys.executable, "-c", TIMER.format(setup=setup, code=code)], cwd=HERE,
+                         capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+def run_benchmark(runs):
+    results = {}
+    for name, code in CASES.items():
+        times = [time_case(code) for _ in range(runs)]
+        results[name] = (min(times), median(times))
+    return results
+
+
+# ******************************************************************************
+# Main
+# ******************************************************************************
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time cold start imports")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'case':<28}{'min (s)':>10}{'median (s)':>12}")
+    for name, (best, med) in run_benchmark(args.runs).items():
+        print(f"{name:<28}{best:>10.3f}{med:>12.3f}")
@@ -3,21 +3,14 @@
 
 
 import csv
-import tifffile as tf
 from os import path
 
-# want to have an empty space flag
-def get_data(well, file_d, nucpts_d, count_threshold, ceiling_threshold):
-    img = tf.imread(file_d[well])
-    max = img.max()
-    count = len(nucpts_d[well])
-    count_flag = False
-    ceil_flag = False
-    if count < count_threshold: count_flag = True
-    if max > ceiling_threshold: ceil_flag = True
-    
-    return (max, count, count_flag, ceil_flag)
-    
+import numpy as np
+
+from plate_result import FLAG_LOW_COUNT, FLAG_BRIGHT, well_tag
+from nucleus_features import FEATURE_COLUMNS
+
+
 def get_flags(count_flag, ceil_flag):
     if count_flag:
         if ceil_flag:
@@ -27,32 +20,44 @@ def get_flags(count_flag, ceil_flag):
         return "Bright spots"
     return "No flags"
 
-def export_data(dirname, filename, file_d, nucpts_d, count_threshold, 
+def export_data(dirname, filename, plate, count_threshold, 
                     ceiling_threshold):
     if filename.endswith('.csv') == False:
             filename = filename + ".csv"
     filepath = path.join(dirname, filename)
+    flags = plate.update_flags(count_threshold, ceiling_threshold)
     with open(filepath, 'w', encoding='UTF8', newline='') as f:
         writer = csv.writer(f)
-        header = ["Well", "Count", "Max value", "Flag(s)", "Filename"]
-        count_flags = 0
-        ceil_flags = 0
+        header = ["Well", "Count", "Max value", "Total intensity", "Flag(s)", "Filename"]
         blank_flags = 0
         writer.writerow(header)
-        for well in file_d.keys():
-            (max, count, count_flag, ceil_flag) = get_data(well, file_d, nucpts_d, 
-                                                            count_threshold, 
-                                                            ceiling_threshold)
-            flag = get_flags(count_flag, ceil_flag)
-            if count_flag: count_flags += 1
-            if ceil_flag: ceil_flags += 1
-            row = [well, str(count), max, flag, file_d[well]]
+        for idx in zip(*np.nonzero(plate.analyzed)):
+            count_flag = bool(flags[idx] & FLAG_LOW_COUNT)
+            ceil_flag = bool(flags[idx] & FLAG_BRIGHT)
+            max = plate.max_intensity[idx]
+            if max.is_integer(): max = int(max)
+            # NaN while a quick QC well has not been refined yet
+            total = "" if np.isnan(plate.sum_intensity[idx]) else plate.sum_intensity[idx]
+            row = [well_tag(*idx), str(plate.counts[idx]), max, total, get_flags(count_flag, ceil_flag), plate.files[idx]]
             writer.writerow(row)
-        
+
+        count_flags = np.count_nonzero(flags & FLAG_LOW_COUNT)
+        ceil_flags = np.count_nonzero(flags & FLAG_BRIGHT)
         summary = ["Files Analyzed", "Total flags", "Cell count flags", 
                     "Bright spot flags", "Blank spot flags"]
         writer.writerow(summary)
-        summary_data = [str(len(file_d)), str(count_flags + ceil_flags), 
+        summary_data = [str(np.count_nonzero(plate.analyzed)), str(count_flags + ceil_flags), 
                         str(count_flags), str(ceil_flags), str(blank_flags)]
         writer.writerow(summary_data)
-    return
\ No newline at end of file
+    return
+
+# Write a per nucleus feature table (see nucleus_features.py), one row per nucleus
+def export_features(dirname, filename, table):
+    if filename.endswith('.csv') == False:
+            filename = filename + ".csv"
+    filepath = path.join(dirname, filename)
+    with open(filepath, 'w', encoding='UTF8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(FEATURE_COLUMNS)
+        writer.writerows(zip(*(table[c].tolist() for c in FEATURE_COLUMNS)))
+    return
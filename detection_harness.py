@@ -0,0 +1,248 @@
+# Detection Harness
+# Differential check of optimized detection paths against the reference implementation
+# Max Jantos
+#
+# Every engine takes a raw image (and maxthresh) and returns nucpts. Each case runs the
+# reference engine and the engine under test on the same image and reports the count delta,
+# how many centers match within a distance tolerance, and the speedup.
+#
+# Run from the command line (exits with status 1 if any case fails):
+#   python detection_harness.py --engine preview --synthetic 10
+#   python detection_harness.py --engine preview --golden <dir>      (golden set recorded with --record)
+#   python detection_harness.py --engine preview --plate <dir> --fraction 0.05
+
+import sys
+import json
+import time
+import random
+import argparse
+from os import path, listdir
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from lazy_import import lazy_module
+from nuclei_detection import detect_nuclei, normalize_img, get_filenames, DEFAULT_PARAMS
+from pooling import mean_pool, max_pool
+from projection import project_stack
+from qc_preview import preview_nuc_centers, max_preview_factor
+
+spatial = lazy_module("scipy.spatial")
+ndimage = lazy_module("scipy.ndimage")
+
+
+GOLDEN_NAME = "golden.json"
+
+
+# ******************************************************************************
+# Engines
+# ******************************************************************************
+
+# the current implementation, everything else is compared against it
+def reference_engine(raw_img, maxthresh=17500):
+    return detect_nuclei(normalize_img(raw_img, maxthresh), **DEFAULT_PARAMS)
+
+# quick QC preview on every k-th row and column (the largest decimation it allows by default)
+def preview_engine(raw_img, maxthresh=17500, k=None):
+    if k is None: k = max_preview_factor()
+    return preview_nuc_centers(raw_img[::k, ::k], k, maxthresh)
+
+# reference with the filter stages run concurrently on threads (the interactive single image path)
+FILTER_THREADS = ThreadPoolExecutor(max_workers=2)
+
+def threaded_engine(raw_img, maxthresh=17500):
+    return detect_nuclei(normalize_img(raw_img, maxthresh), **DEFAULT_PARAMS, executor=FILTER_THREADS)
+
+# name : engine(raw_img, maxthresh) -> nucpts
+# new detection paths are added here (or with register_engine) to be checked
+ENGINES = {
+    "reference": reference_engine,
+    "preview": preview_engine,
+    "threaded": threaded_engine,
+}
+
+def register_engine(name, engine):
+    ENGINES[name] = engine
+
+
+# ******************************************************************************
+# Cases
+# ******************************************************************************
+
+# Synthetic DAPI-like image: gaussian nuclei on a noisy, uneven background
+# returns (uint16 image, true centers)
+def synthetic_image(shape=(512, 512), n_nuclei=150, radius=4.0, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.integers(8, np.array(shape) - 8, size=(n_nuclei, 2))
+    impulses = np.zeros(shape)
+    impulses[centers[:, 0], centers[:, 1]] = rng.uniform(0.6, 1.0, n_nuclei)
+    nuclei = ndimage.gaussian_filter(impulses, radius) * (2 * np.pi * radius**2)
+    y, x = np.mgrid[0:shape[0], 0:shape[1]]
+    background = 0.05 + 0.05 * (x / shape[1]) # illumination falling off across the field
+    img = 8000 * (nuclei + background) + rng.normal(0, 100, shape)
+    return (np.clip(img, 0, 65535).astype(np.uint16), centers)
+
+# (name, raw image, expected nucpts or None) for n synthetic images
+def synthetic_cases(n, shape=(512, 512)):
+    for seed in range(n):
+        img, _ = synthetic_image(shape, seed=seed)
+        yield (f"synthetic {seed}", img, None)
+
+# Record the reference results of every tif in dirname as its golden set
+def record_golden(dirname, maxthresh=17500):
+    golden = {}
+    for f in sorted(listdir(dirname)):
+        if not f.endswith(".tif") or "_thumb" in f: continue
+        raw_img = project_stack(path.join(dirname, f), ("max",))["max"]
+        golden[f] = reference_engine(raw_img, maxthresh).tolist()
+    with open(path.join(dirname, GOLDEN_NAME), 'w', encoding='UTF8') as fp:
+        json.dump({"maxthresh": maxthresh, "nucpts": golden}, fp)
+    return golden
+
+# (name, raw image, recorded nucpts) for every image of a golden set
+def golden_cases(dirname):
+    with open(path.join(dirname, GOLDEN_NAME), encoding='UTF8') as fp:
+        golden = json.load(fp)
+    for f, nucpts in golden["nucpts"].items():
+        raw_img = project_stack(path.join(dirname, f), ("max",))["max"]
+        yield (f, raw_img, np.array(nucpts).reshape(-1, 2))
+
+# (name, raw image, None) for a random fraction of a plate's wells
+def plate_sample_cases(dirname, fraction=0.05, pattern=0, site=5, seed=None):
+    file_d = get_filenames(dirname, pattern, site)
+    wells = sorted(file_d.keys())
+    n = max(1, round(fraction * len(wells))) if wells else 0
+    for well in random.Random(seed).sample(wells, n):
+        yield (well, project_stack(file_d[well], ("max",))["max"], None)
+
+
+# ******************************************************************************
+# Comparison
+# ******************************************************************************
+
+# Match two sets of centers one to one, closest pairs first, within tol pixels
+# returns (number matched, mean distance of the matches)
+def match_points(a, b, tol=3.0):
+    a = np.asarray(a).reshape(-1, 2)
+    b = np.asarray(b).reshape(-1, 2)
+    if len(a) == 0 or len(b) == 0: return (0, 0.0)
+    pairs = spatial.cKDTree(a).sparse_distance_matrix(spatial.cKDTree(b), tol, output_type='ndarray')
+    if len(pairs) == 0: return (0, 0.0)
+    pairs = pairs[np.argsort(pairs['v'], kind='stable')]
+    used_a = np.zeros(len(a), dtype=bool)
+    used_b = np.zeros(len(b), dtype=bool)
+    dists = []
+    for i, j, d in zip(pairs['i'], pairs['j'], pairs['v']):
+        if used_a[i] or used_b[j]: continue
+        used_a[i] = used_b[j] = True
+        dists.append(d)
+    return (len(dists), float(np.mean(dists)))
+
+# best of repeat runs, returns (nucpts, seconds)
+def timed(engine, raw_img, maxthresh, repeat=1):
+    best, nucpts = np.inf, None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        nucpts = engine(raw_img, maxthresh)
+        best = min(best, time.perf_counter() - t0)
+    return (np.asarray(nucpts).reshape(-1, 2), best)
+
+# Run the reference and the engine under test on every case
+# expected (golden) nucpts stand in for a fresh reference run when a case has them,
+# the reference is still timed for the speedup
+# returns a list of dicts, one per case
+def run_harness(engine_name, cases, maxthresh=17500, tol=3.0, repeat=1):
+    engine = ENGINES[engine_name]
+    rows = []
+    warm = False
+    for name, raw_img, expected in cases:
+        if not warm:
+            # untimed first runs, so loading the lazy modules and filling caches doesn't land on the first case
+            reference_engine(raw_img, maxthresh)
+            engine(raw_img, maxthresh)
+            warm = True
+        ref_pts, ref_time = timed(reference_engine, raw_img, maxthresh, repeat)
+        if expected is not None: ref_pts = expected
+        alt_pts, alt_time = timed(engine, raw_img, maxthresh, repeat)
+        matched, mean_dist = match_points(ref_pts, alt_pts, tol)
+        rows.append({"case": name, "reference": len(ref_pts), "engine": len(alt_pts),
+                     "delta": len(alt_pts) - len(ref_pts),
+                     "recall": matched / len(ref_pts) if len(ref_pts) else 1.0,
+                     "precision": matched / len(alt_pts) if len(alt_pts) else 1.0,
+                     "mean_dist": mean_dist, "speedup": ref_time / alt_time if alt_time > 0 else np.inf})
+    return rows
+
+# a case passes when the counts agree within count_tol (fraction of the reference count)
+# and at least min_match of the reference centers are found again
+def case_passes(row, count_tol=0.0, min_match=1.0):
+    return (abs(row["delta"]) <= count_tol * row["reference"] and
+            row["recall"] >= min_match and row["precision"] >= min_match)
+
+# Block pooling one block at a time, with the zero padding block_reduce used (the pooling kernels' reference)
+def naive_pool(img, block, func):
+    h, w = -(-img.shape[0] // block), -(-img.shape[1] // block)
+    padded = np.zeros((h * block, w * block), dtype=img.dtype)
+    padded[:img.shape[0], :img.shape[1]] = img
+    out = np.empty((h, w), dtype=np.float64)
+    for r in range(h):
+        for c in range(w):
+            out[r, c] = func(padded[r * block:(r + 1) * block, c * block:(c + 1) * block])
+    return out
+
+# The pooling kernels must give what the naive per block loop gives, on shapes that are not
+# a multiple of the block too (max exactly, mean up to float rounding)
+def check_pooling_kernels(shapes=((64, 64), (61, 59), (37, 64), (5, 3)), blocks=(1, 2, 3, 4)):
+    rng = np.random.default_rng(0)
+    for shape in shapes:
+        img = rng.uniform(0, 255, shape)
+        for b in blocks:
+            if not np.allclose(mean_pool(img, b), naive_pool(img, b, np.mean), rtol=1e-12, atol=0): return False
+            if not np.array_equal(max_pool(img, b), naive_pool(img, b, np.max)): return False
+    return True
+
+def print_report(engine_name, rows, count_tol, min_match):
+    print(f"{'case':<24}{'ref':>7}{engine_name[:8]:>9}{'delta':>7}{'recall':>8}{'prec':>7}{'dist':>7}{'speedup':>9}  ok")
+    for row in rows:
+        ok = "yes" if case_passes(row, count_tol, min_match) else "NO"
+        print(f"{row['case'][:23]:<24}{row['reference']:>7}{row['engine']:>9}{row['delta']:>7}"
+              f"{row['recall']:>8.3f}{row['precision']:>7.3f}{row['mean_dist']:>7.2f}{row['speedup']:>9.2f}  {ok}")
+
+
+# ******************************************************************************
+# Main
+# ******************************************************************************
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare a detection engine against the reference implementation")
+    parser.add_argument("--engine", default="preview", choices=sorted(ENGINES.keys()))
+    parser.add_argument("--synthetic", type=int, default=0, help="number of synthetic images to check")
+    parser.add_argument("--golden", help="golden set directory (holding golden.json)")
+    parser.add_argument("--record", action="store_true", help="record the golden set of --golden instead of checking it")
+    parser.add_argument("--plate", help="plate directory to sample production wells from")
+    parser.add_argument("--fraction", type=float, default=0.05, help="fraction of the plate's wells to sample")
+    parser.add_argument("--pattern", type=int, default=0)
+    parser.add_argument("--site", type=int, default=5)
+    parser.add_argument("--maxthresh", type=int, default=17500)
+    parser.add_argument("--tol", type=float, default=3.0, help="distance in pixels for two centers to match")
+    parser.add_argument("--count-tol", type=float, default=0.0, help="allowed count difference, as a fraction of the reference count")
+    parser.add_argument("--min-match", type=float, default=1.0, help="required recall and precision of the matched centers")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per engine and case, the best time is used")
+    args = parser.parse_args()
+
+    if args.record:
+        if not args.golden: parser.error("--record needs --golden")
+        print(f"Recorded {len(record_golden(args.golden, args.maxthresh))} golden images")
+        sys.exit(0)
+
+    passed = check_pooling_kernels()
+    print(f"Pooling kernels match the per block reference: {'yes' if passed else 'NO'}")
+
+    cases = []
+    if args.synthetic: cases.append(synthetic_cases(args.synthetic))
+    if args.golden: cases.append(golden_cases(args.golden))
+    if args.plate: cases.append(plate_sample_cases(args.plate, args.fraction, args.pattern, args.site))
+    for case_set in cases:
+        rows = run_harness(args.engine, case_set, args.maxthresh, args.tol, args.repeat)
+        print_report(args.engine, rows, args.count_tol, args.min_match)
+        passed = passed and all(case_passes(r, args.count_tol, args.min_match) for r in rows)
+
+    sys.exit(0 if passed else 1)
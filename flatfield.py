@@ -0,0 +1,126 @@
+# Flat Field
+# Plate level illumination model, estimated once per plate and cached on disk
+# Max Jantos
+#
+# A sample of the plate's images is streamed through once, each one mean pooled down to a
+# small grid. The per pixel percentile (median by default) of those grids, smoothed and scaled
+# to a mean of 1, is the illumination profile of the field. Every image is then divided by the
+# profile before detection, a single multiply per image, so the fixed thresholds mean the same
+# thing in dim and bright corners.
+
+import hashlib
+from os import path, stat, makedirs
+
+import numpy as np
+
+from lazy_import import lazy_module
+from pooling import mean_pool
+from projection import project_stack
+
+ndimage = lazy_module("scipy.ndimage")
+
+
+# kept in a subdirectory of the plate so it is never counted as one of the plate's files
+CACHE_DIR = ".flatfield_cache"
+
+
+# ******************************************************************************
+# Model
+# ******************************************************************************
+class FlatField:
+    def __init__(self, profile, shape):
+        self.profile = profile      # illumination on the pooled grid, mean 1
+        self.shape = tuple(shape)   # full resolution image shape the model was built from
+        self.gain = None            # full resolution 1 / profile, made on first use
+
+    # Full resolution multiplier, computed once and reused for every image of the plate
+    def full_gain(self):
+        if self.gain is None:
+            zoom = (self.shape[0] / self.profile.shape[0], self.shape[1] / self.profile.shape[1])
+            full = ndimage.zoom(self.profile, zoom, order=1, mode='nearest', grid_mode=True)
+            # zoom can be a pixel off from the requested shape
+            full = np.pad(full, [(0, max(0, s - f)) for s, f in zip(self.shape, full.shape)], mode='edge')
+            self.gain = (1.0 / full[:self.shape[0], :self.shape[1]]).astype(np.float32)
+        return self.gain
+
+    # the full resolution gain is rebuilt where it is needed rather than sent to worker processes
+    def __getstate__(self):
+        return {"profile": self.profile, "shape": self.shape, "gain": None}
+
+    # The same model for images decimated by k (every k-th row and column)
+    def decimated(self, k):
+        return FlatField(self.profile, (-(-self.shape[0] // k), -(-self.shape[1] // k)))
+
+    # Corrected copy of a raw image (or projection) as float32
+    # images of another shape than the model are returned unchanged
+    def apply(self, raw_img):
+        if raw_img.shape != self.shape: return raw_img
+        return raw_img * self.full_gain()
+
+
+# Estimate the illumination model from a plate's images
+# filenames are sampled evenly down to max_images, each is reduced to a block x block mean pooled grid
+# as it is read so memory stays at one full image plus the small grids
+def estimate_flatfield(filenames, block=16, percentile=50, max_images=64, projection="max", smooth=2.0):
+    filenames = list(filenames)
+    if len(filenames) == 0: return None
+    if len(filenames) > max_images:
+        filenames = [filenames[i] for i in np.linspace(0, len(filenames) - 1, max_images).astype(int)]
+
+    grids = []
+    shape = None
+    for filename in filenames:
+        raw_img = project_stack(filename, (projection,))[projection]
+        if shape is None: shape = raw_img.shape
+        if raw_img.shape != shape: continue
+        grids.append(mean_pool(raw_img.astype(np.float32), block))
+
+    profile = np.percentile(np.stack(grids), percentile, axis=0)
+    # nuclei that happen to sit at the same spot in many images should not show up in the profile
+    profile = ndimage.gaussian_filter(profile, smooth, mode='nearest')
+    mean = profile.mean()
+    if mean <= 0: return None
+    # keep a near empty corner from blowing up the correction
+    profile = np.clip(profile / mean, 0.2, 5.0)
+    return FlatField(profile.astype(np.float32), shape)
+
+
+# ******************************************************************************
+# Per plate cache
+# ******************************************************************************
+
+# key of a set of images: changes when a file is added, removed or rewritten
+def files_key(filenames, projection):
+    h = hashlib.sha1(projection.encode())
+    for filename in sorted(filenames):
+        st = stat(filename)
+        h.update(f"{filename}|{st.st_size}|{st.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+def cache_path(dirname, site, projection):
+    return path.join(dirname, CACHE_DIR, f"s{site}_{projection}.npz")
+
+# Returns the plate's flat field, from the cache in the plate directory when it is still valid,
+# otherwise estimated from file_d's images and cached
+# a plate directory that can't be written to just goes without a cache
+def load_flatfield(dirname, file_d, site, projection="max"):
+    filenames = list(file_d.values())
+    key = files_key(filenames, projection)
+    filepath = cache_path(dirname, site, projection)
+    if path.isfile(filepath):
+        try:
+            with np.load(filepath) as cached:
+                if str(cached["key"]) == key:
+                    return FlatField(cached["profile"], cached["shape"])
+        except (OSError, ValueError, KeyError):
+            pass # unreadable cache, estimate again
+
+    model = estimate_flatfield(filenames, projection=projection)
+    if model is None: return None
+    try:
+        makedirs(path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            np.savez(f, key=key, profile=model.profile, shape=np.array(model.shape))
+    except OSError:
+        pass
+    return model
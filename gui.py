@@ -4,32 +4,41 @@
 
 import time
 import platform
+from concurrent.futures import ThreadPoolExecutor
 
 from tkinter import *
 from tkinter import ttk
 from tkinter import filedialog as fd
 from tkinter.messagebox import showinfo
 
-import matplotlib.pyplot as plt
-
 from scrollable_window import *
 from nuclei_detection import *
 from csv_write import *
+from plate_result import *
+from qc_preview import ProgressiveQC
+from nucleus_features import plate_feature_table
+from mosaic import MosaicBuilder
 
 
 # ******************************************************************************
 # Non-tkinter GUI tools
 # ******************************************************************************
 
-# Display image with the found nuclei centroids "highlighted"
-def visualize_nucpts(scaled_img, nucpts):
-    img = np.copy(scaled_img)
-    for cur_nuc in nucpts:
-        img[cur_nuc[0], cur_nuc[1]] = 500 # arbitrary number to make a peak
-    
-    img = maximum_filter(img, 5) # further highlight the detected points
-    img_show = plt.imshow(img)
-    plt.show()
+# Display image in a figure without blocking, returns its axes for overlay_nucpts
+# matplotlib is imported here rather than with lazy_module: finding the spec of matplotlib.pyplot
+# imports the whole matplotlib package, the slowest part of starting the gui
+def show_img(scaled_img):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    ax.imshow(scaled_img)
+    plt.show(block=False)
+    return ax
+
+# Circle the found nuclei centroids on an image shown with show_img
+def overlay_nucpts(ax, nucpts):
+    if len(nucpts) == 0: return
+    ax.scatter(nucpts[:, 1], nucpts[:, 0], s=20, facecolors='none', edgecolors='red', linewidths=0.8)
+    ax.figure.canvas.draw_idle()
     return
 
 # Given a tif img as a np array
@@ -66,6 +75,13 @@ class App(Tk):
         self.site = -1 # 0 = all available imaged sites, 1-9 = only that specific site's image analyzed, -1 means not selected
         self.pattern_store = IntVar(value = -1)
         self.site_store = IntVar(value = -1)
+        # intensity projection analyzed for multi-page (z-stack / time series) tiffs
+        self.projection = "max" # "max", "sum" or "focus"
+        self.projection_store = StringVar(value = "max")
+        # divide out the plate's illumination profile before detection (see flatfield.py)
+        self.flatfield = False
+        self.flatfield_store = BooleanVar(value = False)
+        self.flatfield_model = None # model the current plate was analyzed with, None if it was not corrected
         # setting initial thresholds
         self.count_thresh = 2000
         self.ceiling_thresh = 17500
@@ -76,14 +92,16 @@ class App(Tk):
         self.start_time = 0
         self.end_time = 0
 
-        # Declare various data dictionaries for operating on a whole folder
+        # Results of operating on a whole folder
         # well tag with site = {row tag}{col tag} s{site number} (i.e. C17 s5)
-        self.file_d = None          # well tag with site : image's filepath (only for wells that have been analyzed)
-        self.nucpts_d = None        # well tag with site : list of nucpt coordinates (only for wells that have been analyzed)
-        self.nucCounts_d = None     # well tag with site : number of nuclei detected (only for wells that have been analyzed)
-        self.sum_ips_d = None       # well tag with site : sum intensity projection (only for wells that have been analyzed)
+        self.plate = None           # PlateResult holding filepaths, nucpts, counts and intensities indexed by (row, col, site)
+        self.filter_threads = None  # thread pool for the filter stages of single image analysis, made on first use
+        self.mosaic = None          # MosaicBuilder of the current directory, made on first use
+        self.qc = None              # ProgressiveQC refining a quick QC preview in the background
+        self.sum_ips_d = None       # well tag with site : total intensity of the sum intensity projection (only for wells that have been analyzed)
 
         self.well_buttons = None    # well tag : corresponding button on wellplate
+        self.well_grid = None       # (row, col, button) of every well button, 0 based plate indices
         self.data_labels = None
 
         # set up main window
@@ -109,7 +127,7 @@ class App(Tk):
         output_frame.pack(side="right")
 
         # setup the wellplate
-        wellplate_scrollFrame, self.well_buttons = self.create_wellplate_scrollFrame(self)
+        wellplate_scrollFrame, self.well_buttons, self.well_grid = self.create_wellplate_scrollFrame(self)
         wellplate_scrollFrame.pack(side='top', fill='both', expand=True)
 
     # copies given string to clipboard
@@ -119,6 +137,9 @@ class App(Tk):
     
     # Command to exit any window
     def close(self, top):
+        if top is self:
+            self.stop_qc()
+            if self.filter_threads != None: self.filter_threads.shutdown(wait=False)
         top.destroy()
         top.update()
 
@@ -133,6 +154,11 @@ class App(Tk):
         self.site = -1 # 0 = all available imaged sites, 1-9 = only that specific site's image analyzed
         self.pattern_store.set(-1)
         self.site_store.set(-1)
+        self.projection = "max"
+        self.projection_store.set("max")
+        self.flatfield = False
+        self.flatfield_store.set(False)
+        self.flatfield_model = None
         self.count_thresh = 2000
         self.ceiling_thresh = 17500
         self.count_thresh_store.set("")
@@ -144,32 +170,36 @@ class App(Tk):
         self.start_time = 0
         self.end_time = 0
 
-        # Reset dictionaries
-        self.file_d = None
-        self.nucpts_d = None
-        self.nucCounts_d = None
+        # Reset results
+        self.stop_qc()
+        self.mosaic = None
+        self.plate = None
         self.sum_ips_d = None
 
         self.update_gui()
 
     # Creates 2 popup windows: a data popup and a visualization popup
-    def summary_popup(self, filename, nucpts, nuc_count, flag):
+    # the count is shown first, peak data and the nuclei overlay fill in on the following event loop ticks
+    # projs: projections of the file if it has already been read (see project_stack)
+    # latency: seconds from file selection to the count, shown when given
+    # well: well tag the image belongs to, adds a button to open that well's mosaic
+    def summary_popup(self, filename, nucpts, nuc_count, flag, projs=None, latency=None, well=None):
         newWindow = Toplevel(self)
         newWindow.title("Image Summary")
         newWindow.resizable(True, True)
-        newWindow.geometry("500x350")
-        raw_img = tf.imread(filename)
-        (max_peak, min_peak, avg_peak, median_peak, max, min) = image_data_summary(raw_img, nucpts)
+        newWindow.geometry("500x370")
 
         data_title = Label(newWindow, text="Nuclei Peak Data", font="Helvetica 16 bold")
         count = Label(newWindow, text=f"Nuclei Count: {nuc_count}")
-        sum_ip = Label(newWindow, text=f"Total Intensity: {np.sum(raw_img)}")
-        max_val = Label(newWindow, text=f"Maximum value: {max}")
-        min_val = Label(newWindow, text=f"Minimum value: {min}")
-        max_peak_int = Label(newWindow, text=f"Maximum peak intensity: {max_peak}")
-        min_peak_int = Label(newWindow, text=f"Minimum peak intensity: {min_peak}")
-        avg_peak_int = Label(newWindow, text=f"Average peak intensity: {avg_peak}")
-        median_peak_int = Label(newWindow, text=f"Median peak intensity: {median_peak}")
+        time_to_count = Label(newWindow, text="" if latency is None else f"Time to count: {latency:.3f} seconds")
+        sum_ip = Label(newWindow, text="Total Intensity: ...")
+        pages = Label(newWindow, text="Pages: ...")
+        max_val = Label(newWindow, text="Maximum value: ...")
+        min_val = Label(newWindow, text="Minimum value: ...")
+        max_peak_int = Label(newWindow, text="Maximum peak intensity: ...")
+        min_peak_int = Label(newWindow, text="Minimum peak intensity: ...")
+        avg_peak_int = Label(newWindow, text="Average peak intensity: ...")
+        median_peak_int = Label(newWindow, text="Median peak intensity: ...")
         flag = Label(newWindow, text=f"Flags: {flag}", font="Helvetica 12 bold")
         file_path = Label(newWindow, text=f"File Path: {filename}", justify="left", wraplength=300)
 
@@ -179,7 +209,9 @@ class App(Tk):
         file_path.pack(side="top", anchor="nw")
         data_title.pack(side="top", anchor="nw")
         count.pack(side="top", anchor="nw")
+        time_to_count.pack(side="top", anchor="nw")
         sum_ip.pack(side="top", anchor="nw")
+        pages.pack(side="top", anchor="nw")
         max_val.pack(side="top", anchor="nw")
         min_val.pack(side="top", anchor="nw")
         max_peak_int.pack(side="top", anchor="nw")
@@ -194,20 +226,52 @@ class App(Tk):
 
         copy_button.grid(column = 0, row = 0)
         quit_button.grid(column = 1, row = 0)
+        if well != None:
+            mosaic_button = Button(button_frame, text="Well mosaic", command= lambda: self.show_well_mosaic(well))
+            mosaic_button.grid(column = 2, row = 0)
         
         button_frame.pack(side="top", anchor="nw")
-        
-        scaled_img = scale_img(raw_img)
-        visualize_nucpts(scaled_img, nucpts)
+
+        def fill_peak_data():
+            nonlocal projs
+            if projs is None:
+                projs = project_stack(filename, tuple(dict.fromkeys(("sum", self.projection))))
+            raw_img = projs[self.projection]
+            sum_ip.configure(text=f"Total Intensity: {np.sum(projs['sum'])}")
+            pages.configure(text=f"Pages: {projs['pages']} ({self.projection_as_str()} analyzed)")
+            max_val.configure(text=f"Maximum value: {raw_img.max()}")
+            min_val.configure(text=f"Minimum value: {raw_img.min()}")
+            (max_peak, min_peak, avg_peak, median_peak) = ("NO DATA", "NO DATA", "NO DATA", "NO DATA")
+            if len(nucpts) > 0:
+                (max_peak, min_peak, avg_peak, median_peak, _, _) = image_data_summary(raw_img, nucpts)
+            max_peak_int.configure(text=f"Maximum peak intensity: {max_peak}")
+            min_peak_int.configure(text=f"Minimum peak intensity: {min_peak}")
+            avg_peak_int.configure(text=f"Average peak intensity: {avg_peak}")
+            median_peak_int.configure(text=f"Median peak intensity: {median_peak}")
+            # image first, nuclei overlay on the next tick
+            ax = show_img(scale_img(raw_img))
+            newWindow.after(1, lambda: overlay_nucpts(ax, nucpts))
+
+        # let the window draw with the count before the rest is computed
+        newWindow.after(1, fill_peak_data)
 
     # Command run when you choose one file
+    # latency path: the file is read once, the filter stages run on threads,
+    # and the count is shown before the peak data and overlay
     def single_file(self):
         filename = select_file()
         self.start_time = time.perf_counter()
-        data = single_file_analysis(filename)
+        if filename == "":
+            showinfo(title='Error', message="No file selected")
+            return
+        projs = project_stack(filename, tuple(dict.fromkeys(("sum", self.projection))))
+        if self.filter_threads == None:
+            self.filter_threads = ThreadPoolExecutor(max_workers=2)
+        img = normalize_img(projs[self.projection], projection_thresh(17500, self.projection, projs["pages"]))
+        nucpts = get_nuc_centers(img, executor=self.filter_threads)
         self.end_time = time.perf_counter()
-        if data != None:
-            self.summary_popup(data[0], data[1], data[2], "None")
+        if nucpts is not None:
+            self.summary_popup(filename, nucpts, len(nucpts), "None", projs, self.end_time - self.start_time)
             return
         #showinfo(title='Error', message="Something went wrong")
         return
@@ -215,21 +279,80 @@ class App(Tk):
     # Command run when you choose a directory
     def multiple_files(self):
         self.dirname = select_directory()
+        self.stop_qc()
 
         self.start_time = time.perf_counter()
-        data = multi_file_analysis(self.dirname, self.pattern, self.ceiling_thresh, self.site)
+        data = multi_file_analysis(self.dirname, self.pattern, self.ceiling_thresh, self.site, self.projection,
+                                   self.flatfield)
         self.end_time = time.perf_counter()
 
         if data != None:
             self.data = True
-            (self.file_d, self.nucpts_d, self.nucCounts_d, self.total_files) = data
-            self.files_analyzed = len(self.nucpts_d)
+            (file_d, nucpts_d, nucCounts_d, self.total_files, self.sum_ips_d, max_d) = data
+            self.plate = PlateResult.from_dicts(file_d, nucpts_d, self.well_dim, self.dirname, self.total_files,
+                                                max_d=max_d, sum_ips_d=self.sum_ips_d)
+            # comes straight from the cache multi_file_analysis just wrote
+            self.flatfield_model = load_flatfield(self.dirname, file_d, self.site, self.projection) if self.flatfield else None
+            self.files_analyzed = int(np.count_nonzero(self.plate.analyzed))
             # update wellplate buttons according to newly collected data
             self.update_gui()
         return
 
+    # Command run when you choose a directory for a quick QC
+    # shows approximate results from decimated images first, then refines them in the background
+    def quick_qc(self):
+        self.dirname = select_directory()
+        if self.dirname == "": return
+        self.stop_qc()
+
+        total_files = len([f for f in listdir(self.dirname) if path.isfile(path.join(self.dirname,f))])
+        if total_files == 0:
+            showinfo(title='Error', message="No files in selected directory")
+            return
+        file_d = get_filenames(self.dirname, self.pattern, self.site)
+        if len(file_d) == 0:
+            showinfo(title='Error', message="No files that match the selected search parameters")
+            return
+
+        self.start_time = time.perf_counter()
+        self.flatfield_model = load_flatfield(self.dirname, file_d, self.site, self.projection) if self.flatfield else None
+        self.qc = ProgressiveQC(file_d, self.ceiling_thresh, self.count_thresh, self.ceiling_thresh,
+                                projection=self.projection, flatfield=self.flatfield_model)
+        self.qc.preview()
+        self.end_time = time.perf_counter()
+
+        self.data = True
+        self.total_files = total_files
+        self.sum_ips_d = None
+        self.plate = self.qc.to_plate(self.well_dim, self.dirname, self.total_files)
+        self.files_analyzed = int(np.count_nonzero(self.plate.analyzed))
+        self.update_gui()
+
+        self.qc.refine()
+        qc = self.qc
+        self.after(500, lambda: self.poll_qc(qc))
+        return
+
+    # Moves full resolution results from the quick QC into the plate as they arrive
+    # qc: the run this poll belongs to, a poll left over from a stopped or replaced run does nothing
+    def poll_qc(self, qc):
+        if qc is not self.qc: return
+        for well, nucpts, max_value, sum_value in qc.pop_refined():
+            if nucpts is None: continue
+            idx = self.plate.index(well)
+            self.plate.set_site(well, self.plate.files[idx], nucpts, max_value, sum_value)
+        self.update_gui()
+        if not qc.done():
+            self.after(500, lambda: self.poll_qc(qc))
+        return
+
+    def stop_qc(self):
+        if self.qc != None:
+            self.qc.stop()
+            self.qc = None
+
     # Command to update/set the search and well parameters
-    def update_params(self, top):
+    def update_params(self, top, quick=False):
         if self.site_store.get() == 0:
             showinfo(title='Error', message="All sites option is not setup yet. Select a different site")
             return
@@ -238,17 +361,22 @@ class App(Tk):
             return
         self.pattern = self.pattern_store.get()
         self.site = self.site_store.get()
+        self.projection = self.projection_store.get()
+        self.flatfield = self.flatfield_store.get()
         self.pattern_store.set(-1)
         self.site_store.set(-1)
 
         top.destroy()
         top.update()
 
+        if quick:
+            self.quick_qc()
+            return
         self.multiple_files()
         return
 
     # Popup to choose site and pattern parameters
-    def search_param_selection(self):
+    def search_param_selection(self, quick=False):
         newWindow = Toplevel(self)
 
         pattern_label = Label(newWindow, text="Pattern", font="Helvetica 18 bold")
@@ -267,7 +395,23 @@ class App(Tk):
             siteButton = Radiobutton(newWindow, text=f"Site {i + 1}", variable=self.site_store, value = i+1)
             siteButton.grid(column = 1, row = i + 1, sticky="w")
 
-        confirm = Button(newWindow, text="Confirm", command= lambda: self.update_params(newWindow))
+        projection_label = Label(newWindow, text="Z-stack", font="Helvetica 18 bold")
+        maxProj = Radiobutton(newWindow, text="Max projection", variable=self.projection_store, value = "max")
+        sumProj = Radiobutton(newWindow, text="Sum projection", variable=self.projection_store, value = "sum")
+        focusProj = Radiobutton(newWindow, text="Best focus page", variable=self.projection_store, value = "focus")
+
+        projection_label.grid(column = 2, row = 0)
+        maxProj.grid(column = 2, row = 1, sticky="w")
+        sumProj.grid(column = 2, row = 2, sticky="w")
+        focusProj.grid(column = 2, row = 3, sticky="w")
+
+        correction_label = Label(newWindow, text="Illumination", font="Helvetica 18 bold")
+        flatfield = Checkbutton(newWindow, text="Flat-field correction", variable=self.flatfield_store)
+
+        correction_label.grid(column = 2, row = 5)
+        flatfield.grid(column = 2, row = 6, sticky="w")
+
+        confirm = Button(newWindow, text="Confirm", command= lambda: self.update_params(newWindow, quick))
         cancel = Button(newWindow, text="Cancel", command= lambda: self.close(newWindow))
 
         confirm.grid(column = 0, row = 11)
@@ -324,15 +468,18 @@ class App(Tk):
         dirname.set(value=selected)
         dir_label.configure(text=selected)
         
-    def write_wrapper(self, top, dirname_var, filename_var):
+    def write_wrapper(self, top, dirname_var, filename_var, features_var):
         dir = dirname_var.get()
         file = filename_var.get()
         if dir == '' or file == '':
             showinfo(title='Error', message='Must input valid filename and select valid directory')
             return
         top.destroy()
-        export_data(dir, file, self.file_d, self.nucpts_d, self.count_thresh, 
-                    self.ceiling_thresh)
+        export_data(dir, file, self.plate, self.count_thresh, self.ceiling_thresh)
+        if features_var.get():
+            table = plate_feature_table(self.plate, self.ceiling_thresh, self.projection,
+                                        flatfield=self.flatfield_model)
+            export_features(dir, file.removesuffix(".csv") + "_features", table)
 
     def export_data_popup(self, master):
         if self.data == False:
@@ -341,13 +488,15 @@ class App(Tk):
         newWindow = Toplevel(master)
         filename = StringVar()
         dirname = StringVar()
+        features = BooleanVar(value=False)
 
         file_label = Label(newWindow, text="Filename: ")
         dir_label = Label(newWindow, text="Directory: ")
         filename_input = Entry(newWindow, textvariable = filename)
         chosen_dir_label = Label(newWindow, text="None selected")
         dir_button = Button(newWindow, text="Select Directory", command= lambda: self.get_save_directory(dirname, chosen_dir_label))
-        confirm_button = Button(newWindow, text="Export", command= lambda: self.write_wrapper(newWindow, dirname, filename))
+        features_check = Checkbutton(newWindow, text="Also export per nucleus features", variable = features)
+        confirm_button = Button(newWindow, text="Export", command= lambda: self.write_wrapper(newWindow, dirname, filename, features))
         quit_button = Button(newWindow, text="Quit", command= newWindow.destroy)
 
         file_label.grid(column = 0, row = 0)
@@ -355,7 +504,8 @@ class App(Tk):
         filename_input.grid(column = 1, row = 0)
         chosen_dir_label.grid(column = 1, row = 1)
         dir_button.grid(column = 2, row = 1)
-        confirm_button.grid(column = 0, row = 2)
+        features_check.grid(column = 0, row = 2, columnspan = 2, sticky = "w")
+        confirm_button.grid(column = 0, row = 3)
         return
 
     def create_button_frame(self, master):
@@ -363,17 +513,21 @@ class App(Tk):
 
         openFile_button = Button(frame, text='Select a file', command=self.single_file)
         openDir_button = Button(frame, text='Select a folder', command= self.search_param_selection)
+        quickQC_button = Button(frame, text='Quick QC', command= lambda: self.search_param_selection(quick=True))
         threshold_button = Button(frame, text='Change thresholds', command= self.select_thresholds)
         self.export_button = Button(frame, text='Export data', state='disabled', command= lambda: self.export_data_popup(self))
+        self.mosaic_button = Button(frame, text='Plate mosaic', state='disabled', command= self.show_plate_mosaic)
         reset_button = Button(frame, text='Reset', command=self.reset_data)
         quit_button = Button(frame, text='Quit', command= lambda: self.close(self))
 
         openFile_button.grid(column=0, row=0, padx=10, pady=5, sticky='w')
         openDir_button.grid(column=1, row=0, padx=10, pady=5, sticky='w')
-        threshold_button.grid(column=2, row=0, padx=10, pady=5, sticky='w')
-        self.export_button.grid(column=3, row=0, padx=10, pady=5, sticky='w')
-        reset_button.grid(column=4, row=0, padx=10, pady=5, sticky='w')
-        quit_button.grid(column=5, row=0, padx=10, pady=5, sticky='w')
+        quickQC_button.grid(column=2, row=0, padx=10, pady=5, sticky='w')
+        threshold_button.grid(column=3, row=0, padx=10, pady=5, sticky='w')
+        self.export_button.grid(column=4, row=0, padx=10, pady=5, sticky='w')
+        self.mosaic_button.grid(column=5, row=0, padx=10, pady=5, sticky='w')
+        reset_button.grid(column=6, row=0, padx=10, pady=5, sticky='w')
+        quit_button.grid(column=7, row=0, padx=10, pady=5, sticky='w')
 
         return frame
 
@@ -385,6 +539,7 @@ class App(Tk):
         #cols = ["01", "02", "03", "04"]
 
         well_buttons = {}
+        well_grid = []
 
         # place labels and canvases for wells
         for r_i in range(self.well_dim[0] + 1):
@@ -403,8 +558,9 @@ class App(Tk):
                     button = Button(scrollFrame.viewPort, text=well_tag, state="disabled", command= lambda well_tag=well_tag: self.get_well_summary(well_tag))
                     button.grid(column = c_i, row = r_i)
                     well_buttons[well_tag] = button
+                    well_grid.append((r_i - 1, c_i - 1, button))
 
-        return scrollFrame, well_buttons
+        return scrollFrame, well_buttons, well_grid
 
     def pattern_as_str(self):
         if self.pattern == 0:
@@ -422,11 +578,20 @@ class App(Tk):
             return "All available sites"
         return f"Site {self.site}"
 
+    def projection_as_str(self):
+        if self.projection == "sum":
+            return "Sum projection"
+        elif self.projection == "focus":
+            return "Best focus page"
+        return "Max projection"
+
     def update_settings_frame(self):
         self.settings_labels["intensity threshold"].configure(text=f"Maximum intensity threshold: {self.ceiling_thresh}")
         self.settings_labels["count threshold"].configure(text=f"Cell count threshold: {self.count_thresh}")
         self.settings_labels["pattern"].configure(text=f"Analysis pattern: {self.pattern_as_str()}")
         self.settings_labels["site"].configure(text=f"Sites selected: {self.site_as_str()}")
+        self.settings_labels["projection"].configure(text=f"Z-stack: {self.projection_as_str()}")
+        self.settings_labels["flatfield"].configure(text=f"Flat-field correction: {'On' if self.flatfield else 'Off'}")
         return
 
     def create_settings_frame(self, master):
@@ -438,17 +603,23 @@ class App(Tk):
         count_thresh = Label(frame, text=f"Cell count threshold: {self.count_thresh}")
         pattern = Label(frame, text=f"Analysis pattern: {self.pattern_as_str()}")
         site = Label(frame, text=f"Sites selected: {self.site_as_str()}")
+        projection = Label(frame, text=f"Z-stack: {self.projection_as_str()}")
+        flatfield = Label(frame, text=f"Flat-field correction: {'On' if self.flatfield else 'Off'}")
 
         settings_labels["intensity threshold"] = intensity_thresh
         settings_labels["count threshold"] = count_thresh
         settings_labels["pattern"] = pattern
         settings_labels["site"] = site
+        settings_labels["projection"] = projection
+        settings_labels["flatfield"] = flatfield
 
         settings_title.grid(column = 0, row = 0, padx=10, pady=5, sticky='w')
         intensity_thresh.grid(column = 0, row = 1, padx=10, pady=5, sticky='w')
         count_thresh.grid(column = 0, row = 2, padx=10, pady=5, sticky='w')
         pattern.grid(column = 0, row = 3, padx=10, pady=5, sticky='w')
         site.grid(column = 0, row = 4, padx=10, pady=5, sticky='w')
+        projection.grid(column = 0, row = 5, padx=10, pady=5, sticky='w')
+        flatfield.grid(column = 0, row = 6, padx=10, pady=5, sticky='w')
 
         return frame, settings_labels
 
@@ -471,12 +642,14 @@ class App(Tk):
         #max_well, max_count = max(self.nucCounts_d., key=lambda x: x[1])
         img_min = Label(frame, text=f"Minimum nuclei count of NO DATA at NO DATA")
         img_max = Label(frame, text=f"Maximum nuclei count of NO DATA at NO DATA")
+        refined = Label(frame, text="")
 
         labels["image count"] = imgs_analyzed
         labels["time elapsed"] = time_elapsed
         labels["img avg"] = img_s5_avg
         labels["min"] = img_min
         labels["max"] = img_max
+        labels["refined"] = refined
         labels["directory"] = dirname
 
         data_title.grid(column = 0, row = 0, padx=10, pady=5, sticky='w')
@@ -486,6 +659,7 @@ class App(Tk):
         img_s5_avg.grid(column = 0, row = 4, padx=10, pady=5, sticky='w')
         img_min.grid(column = 0, row = 5, padx=10, pady=5, sticky='w')
         img_max.grid(column = 0, row = 6, padx=10, pady=5, sticky='w')
+        refined.grid(column = 0, row = 7, padx=10, pady=5, sticky='w')
 
         return frame, labels
     
@@ -497,41 +671,43 @@ class App(Tk):
         self.data_labels["time elapsed"].configure(text = f"Analysis took {self.end_time - self.start_time} seconds")
 
         min_well, min_count, max_well, max_count, nucCount_avg = ("NO DATA", "NO DATA", "NO DATA", "NO DATA", "NO DATA")
-        if self.nucCounts_d != None:
-            min_well, min_count = min(self.nucCounts_d.items(), key=lambda x: x[1])
-            max_well, max_count = max(self.nucCounts_d.items(), key=lambda x: x[1])
-            nucCount_avg = sum(self.nucCounts_d.values()) / self.files_analyzed
-
+        if self.plate != None and self.plate.analyzed.any():
+            min_well, min_count, max_well, max_count, nucCount_avg = self.plate.count_stats()
     
         self.data_labels["img avg"].configure(text=f"Average cells per analyzed image: {nucCount_avg}")
         self.data_labels["min"].configure(text=f"Minimum nuclei count of {min_count} at {min_well}")
         self.data_labels["max"].configure(text=f"Maximum nuclei count of {max_count} at {max_well}")
+
+        refined_text = ""
+        if self.qc != None:
+            (refined, total) = self.qc.progress()
+            refined_text = f"Quick QC: {refined} out of {total} images refined at full resolution"
+        self.data_labels["refined"].configure(text=refined_text)
         return
 
     # Updates the wellplate buttons based on most recently collected data
     def update_buttons(self):
-        if self.nucpts_d == None:
+        if self.plate == None:
             self.export_button.configure(state='disabled')
+            self.mosaic_button.configure(state='disabled')
             for button in self.well_buttons.values():
                 button.configure(state = "disabled", fg = "black")
             return
         
         
         self.export_button.configure(state='normal')
-        for well, button in self.well_buttons.items():
+        self.mosaic_button.configure(state='normal')
+        flags = self.plate.update_flags(self.count_thresh, self.ceiling_thresh)[:, :, self.site - 1]
+        analyzed = self.plate.analyzed[:, :, self.site - 1]
+        for r, c, button in self.well_grid:
             new_state = "disabled"
             color = "black"
-            adjusted_well = well + f" s{self.site}"
-            if adjusted_well in self.nucCounts_d:
+            if analyzed[r, c]:
                 color = "green"
-                if self.nucCounts_d[adjusted_well] < self.count_thresh:
+                if flags[r, c] & FLAG_LOW_COUNT:
                     color = "red"
-                filename = self.file_d[adjusted_well]
-                img = tf.imread(filename)
-                if img.max() > self.ceiling_thresh:
-
+                if flags[r, c] & FLAG_BRIGHT:
                     color = "yellow"
-                #color = "green" if (self.nucCounts_d[adjusted_well] >= self.count_thresh) else "red"
                 new_state = "normal" 
 
             button.configure(state = new_state, fg = color)
@@ -555,10 +731,65 @@ class App(Tk):
             elif color == 'yellow':
                 flag = "Bright spots detected"
 
-            self.summary_popup(self.file_d[key], self.nucpts_d[key], self.nucCounts_d[key], flag)
+            idx = self.plate.index(key)
+            self.summary_popup(self.plate.files[idx], self.plate.nucpts[idx], self.plate.counts[idx], flag,
+                               well=well_tag)
             return
         return
 
+    # MosaicBuilder for the current directory, its tile cache lives in the directory
+    def get_mosaic(self):
+        if self.mosaic == None or self.mosaic.dirname != self.dirname or self.mosaic.projection != self.projection:
+            self.mosaic = MosaicBuilder(self.dirname, projection=self.projection, shape=self.well_dim)
+        return self.mosaic
+
+    # Plate wide mosaic, clicking a well opens its mosaic
+    def show_plate_mosaic(self):
+        mosaic = self.get_mosaic()
+        plate_img = mosaic.plate_mosaic(0)
+        if plate_img is None:
+            showinfo(title='Error', message="No site images found for a mosaic")
+            return
+        ax = show_img(scale_img(plate_img))
+        ax.set_title("Click a well to open its mosaic")
+
+        def on_click(event):
+            if event.inaxes is not ax or event.xdata is None: return
+            well = mosaic.well_at(0, event.ydata, event.xdata)
+            if well != None: self.show_well_mosaic(well)
+        ax.figure.canvas.mpl_connect('button_press_event', on_click)
+
+    # 3x3 mosaic of a well's sites with the detected nuclei circled, clicking an analyzed site opens its summary
+    def show_well_mosaic(self, well):
+        mosaic = self.get_mosaic()
+        well_img = mosaic.well_mosaic(well)
+        if well_img is None:
+            showinfo(title='Error', message=f"No site images found for {well}")
+            return
+        (r, c, _) = parse_well_tag(well)
+        analyzed = self.plate != None and r < self.plate.shape[0] and c < self.plate.shape[1]
+        site_nucpts = {}
+        if analyzed:
+            site_nucpts = {s + 1: self.plate.nucpts[r, c, s] for s in range(self.plate.shape[2])
+                           if self.plate.analyzed[r, c, s]}
+
+        ax = show_img(scale_img(well_img))
+        ax.set_title(f"{well} - click an analyzed site to open it")
+        overlay_nucpts(ax, mosaic.well_nucpts(site_nucpts))
+
+        def on_click(event):
+            if event.inaxes is not ax or event.xdata is None: return
+            site = mosaic.site_at(event.ydata, event.xdata)
+            if site == None or site not in site_nucpts: return
+            idx = (r, c, site - 1)
+            flag = "None"
+            if self.plate.flags[idx] & FLAG_LOW_COUNT:
+                flag = "Insufficient cell count"
+            elif self.plate.flags[idx] & FLAG_BRIGHT:
+                flag = "Bright spots detected"
+            self.summary_popup(self.plate.files[idx], self.plate.nucpts[idx], self.plate.counts[idx], flag)
+        ax.figure.canvas.mpl_connect('button_press_event', on_click)
+
 
 # ******************************************************************************
 # Main
@@ -0,0 +1,24 @@
+# Lazy Imports
+# Heavy modules (scipy, tifffile, matplotlib) are only loaded the first time
+# one of their attributes is used, so the gui window comes up without waiting on them
+# Max Jantos
+
+import sys
+import importlib.util
+
+
+# Returns the named module without executing it yet
+# the real import happens on first attribute access (i.e. ndimage.convolve)
+# use "import x" style access only, "from x import y" would load it right away
+# for a dotted name the parent package is imported right away (it is needed to find the module),
+# so a submodule of a heavy package (matplotlib.pyplot) is better imported where it is first used
+def lazy_module(name):
+    if name in sys.modules: return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None: raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
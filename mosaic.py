@@ -0,0 +1,199 @@
+# Mosaics
+# Downsampled per well mosaics of the 9 imaged sites and a plate wide mosaic pyramid,
+# backed by an on-disk tile cache so zooming only decodes images that are not cached yet
+# Max Jantos
+#
+# Cache layout (in <plate dir>/.mosaic_cache by default), every tile is a .npy named by a key
+# that changes when its source images change:
+#   site/<key>.npy     - one site pooled down by site_factor
+#   well/<key>.npy     - 3x3 mosaic of a well's site tiles
+#   plate<L>/<key>.npy - plate mosaic, level L has every well mosaic pooled down by 2**(L + 2)
+
+import hashlib
+from os import path, stat, makedirs, replace
+
+import numpy as np
+
+from nuclei_detection import get_filenames
+from plate_result import row_label
+from pooling import mean_pool
+from projection import project_stack
+
+
+SITES = 9
+SITE_GRID = (3, 3)  # sites 1-9 laid out row by row: s1 s2 s3 / s4 s5 s6 / s7 s8 s9
+PLATE_BASE_LEVEL = 2 # plate level 0 pools well mosaics by 2**2, keeps a 384 well plate at a few thousand pixels
+
+
+# grid position (row, col) of a site (1-9) inside its well mosaic
+def site_position(site):
+    return divmod(site - 1, SITE_GRID[1])
+
+def hash_key(*parts):
+    return hashlib.sha1("|".join(str(p) for p in parts).encode()).hexdigest()
+
+
+class MosaicBuilder:
+    def __init__(self, dirname, cache_dir=None, site_factor=8, projection="max", shape=(16, 24)):
+        self.dirname = dirname
+        self.cache_dir = cache_dir or path.join(dirname, ".mosaic_cache")
+        self.site_factor = site_factor
+        self.projection = projection
+        self.shape = shape                      # plate (rows, cols)
+        self.site_files = self.find_site_files()
+        self.tile_shape = None                  # shape of one site tile, known after the first tile
+        self.cell_shapes = {}                   # plate level : shape of one well on it, known once the level is built
+
+    # well tag : {site number : image's filepath} for every site valid_file matches
+    def find_site_files(self):
+        site_files = {}
+        for site in range(1, SITES + 1):
+            for tag, filename in get_filenames(self.dirname, 0, site).items():
+                (well, _) = tag.split(' ', 1)
+                site_files.setdefault(well, {})[site] = filename
+        return site_files
+
+    # **************************************************************************
+    # Tile cache
+    # **************************************************************************
+
+    def cache_file(self, level, key):
+        return path.join(self.cache_dir, level, key + ".npy")
+
+    def load_tile(self, level, key):
+        filepath = self.cache_file(level, key)
+        if not path.isfile(filepath): return None
+        try:
+            return np.load(filepath)
+        except (OSError, ValueError):
+            return None # half written or corrupt tile, rebuild it
+
+    def save_tile(self, level, key, tile):
+        filepath = self.cache_file(level, key)
+        try:
+            makedirs(path.dirname(filepath), exist_ok=True)
+            with open(filepath + ".tmp", 'wb') as f:
+                np.save(f, tile)
+            replace(filepath + ".tmp", filepath)
+        except OSError:
+            pass # read only plate directory, run without a cache
+
+    def site_key(self, well, site):
+        filename = self.site_files.get(well, {}).get(site)
+        if filename is None: return None
+        st = stat(filename)
+        return hash_key(filename, st.st_size, st.st_mtime_ns, self.site_factor, self.projection)
+
+    def well_key(self, well):
+        return hash_key(*(self.site_key(well, s) for s in range(1, SITES + 1)))
+
+    # **************************************************************************
+    # Mosaics
+    # **************************************************************************
+
+    # One site pooled down by site_factor, decoded only if it is not cached
+    def site_tile(self, well, site):
+        key = self.site_key(well, site)
+        if key is None: return None
+        tile = self.load_tile("site", key)
+        if tile is None:
+            raw_img = project_stack(self.site_files[well][site], (self.projection,))[self.projection]
+            tile = mean_pool(raw_img.astype(np.float32), self.site_factor)
+            self.save_tile("site", key, tile)
+        if self.tile_shape is None: self.tile_shape = tile.shape
+        return tile
+
+    # 3x3 mosaic of a well's sites, missing sites are left black
+    def well_mosaic(self, well):
+        key = self.well_key(well)
+        mosaic = self.load_tile("well", key)
+        if mosaic is not None:
+            if self.tile_shape is None:
+                self.tile_shape = (mosaic.shape[0] // SITE_GRID[0], mosaic.shape[1] // SITE_GRID[1])
+            return mosaic
+
+        tiles = {s: self.site_tile(well, s) for s in self.site_files.get(well, {})}
+        if self.tile_shape is None: return None
+        (th, tw) = self.tile_shape
+        mosaic = np.zeros((SITE_GRID[0] * th, SITE_GRID[1] * tw), dtype=np.float32)
+        for site, tile in tiles.items():
+            if tile is None or tile.shape != self.tile_shape: continue
+            (r, c) = site_position(site)
+            mosaic[r * th:(r + 1) * th, c * tw:(c + 1) * tw] = tile
+        self.save_tile("well", key, mosaic)
+        return mosaic
+
+    # pooling factor between a well mosaic and its spot on plate level L
+    def plate_factor(self, level):
+        return 2**(level + PLATE_BASE_LEVEL)
+
+    # Plate wide mosaic at the given pyramid level, wells laid out as on the plate
+    # level L + 1 is built from level L rather than from the wells again
+    def plate_mosaic(self, level=0):
+        key = hash_key(*(self.well_key(w) for w in sorted(self.site_files)), level)
+        mosaic = self.load_tile(f"plate{level}", key)
+        if mosaic is not None:
+            self.cell_shapes[level] = (mosaic.shape[0] // self.shape[0], mosaic.shape[1] // self.shape[1])
+            return mosaic
+
+        if level > 0:
+            mosaic = mean_pool(self.plate_mosaic(level - 1), 2)
+        else:
+            factor = self.plate_factor(0)
+            cells = {}
+            for well in self.site_files:
+                well_img = self.well_mosaic(well)
+                if well_img is not None: cells[well] = mean_pool(well_img, factor)
+            if not cells: return None
+            (ch, cw) = next(iter(cells.values())).shape
+            mosaic = np.zeros((self.shape[0] * ch, self.shape[1] * cw), dtype=np.float32)
+            for r in range(self.shape[0]):
+                for c in range(self.shape[1]):
+                    cell = cells.get(f"{row_label(r)}{c + 1}")
+                    if cell is not None and cell.shape == (ch, cw):
+                        mosaic[r * ch:(r + 1) * ch, c * cw:(c + 1) * cw] = cell
+        self.save_tile(f"plate{level}", key, mosaic)
+        self.cell_shapes[level] = (mosaic.shape[0] // self.shape[0], mosaic.shape[1] // self.shape[1])
+        return mosaic
+
+    # Every plate level down to wells of at most min_cell pixels
+    def plate_pyramid(self, min_cell=8):
+        levels = [self.plate_mosaic(0)]
+        if levels[0] is None: return []
+        while levels[-1].shape[0] // self.shape[0] > min_cell:
+            levels.append(self.plate_mosaic(len(levels)))
+        return levels
+
+    # **************************************************************************
+    # Coordinates
+    # **************************************************************************
+
+    # Nuclei centers of a well's sites in well mosaic coordinates
+    # site_nucpts: {site number : nucpts at full resolution}
+    def well_nucpts(self, site_nucpts):
+        if self.tile_shape is None: return np.zeros((0, 2))
+        (th, tw) = self.tile_shape
+        pts = []
+        for site, nucpts in site_nucpts.items():
+            if nucpts is None or len(nucpts) == 0: continue
+            (r, c) = site_position(site)
+            pts.append(np.asarray(nucpts) / self.site_factor + np.array([r * th, c * tw]))
+        return np.concatenate(pts) if pts else np.zeros((0, 2))
+
+    # well tag at a point (y, x) of a plate level, or None between wells
+    # uses the well size kept when the level was built, so a click never touches the files or the cache
+    def well_at(self, level, y, x):
+        if level not in self.cell_shapes: return None
+        (ch, cw) = self.cell_shapes[level]
+        if ch == 0 or cw == 0: return None
+        (r, c) = (int(y) // ch, int(x) // cw)
+        if not (0 <= r < self.shape[0] and 0 <= c < self.shape[1]): return None
+        well = f"{row_label(r)}{c + 1}"
+        return well if well in self.site_files else None
+
+    # site number at a point (y, x) of a well mosaic
+    def site_at(self, y, x):
+        if self.tile_shape is None: return None
+        (r, c) = (int(y) // self.tile_shape[0], int(x) // self.tile_shape[1])
+        if not (0 <= r < SITE_GRID[0] and 0 <= c < SITE_GRID[1]): return None
+        return r * SITE_GRID[1] + c + 1
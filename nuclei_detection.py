@@ -2,17 +2,21 @@
 # Max Jantos
 
 from os import path, listdir
+from concurrent.futures import Future
 
 import numpy as np
 
-from scipy.ndimage import convolve, maximum_filter, minimum_filter
-from skimage.measure import block_reduce
-
-import tifffile as tf
-
 from tkinter import filedialog as fd
 from tkinter.messagebox import showinfo
 
+from lazy_import import lazy_module
+from pooling import mean_pool, max_pool
+from projection import project_stack
+from flatfield import load_flatfield
+
+ndimage = lazy_module("scipy.ndimage")
+tf = lazy_module("tifffile")
+
 
 # ******************************************************************************
 # File Management
@@ -33,15 +37,30 @@ def select_directory():
     dirname = fd.askdirectory(title='Open directory', initialdir='/')
     return dirname
 
-# TODO: break into scale image function?
-def get_img(filename, maxthresh=17500):
-    raw_img = tf.imread(filename)
+# Given a raw image (or projection), returns a scaled copy ready for detect_nuclei
+# flatfield: optional plate illumination model (see flatfield.py), applied after the bright spot cut
+#            so the cut stays on raw intensities and dim corners don't lose their nuclei to it
+def normalize_img(raw_img, maxthresh=17500, flatfield=None):
+    img = raw_img.astype(np.float64)
     # eliminate brightspots
-    raw_img[raw_img > maxthresh] = 0
+    img[img > maxthresh] = 0
+    if flatfield is not None: img = flatfield.apply(img)
     # rescale DAPI image
-    u, v = np.min(raw_img), np.max(raw_img)
-    raw_img = 255.0 * (raw_img - u) / (v - u)
-    return raw_img
+    u, v = np.min(img), np.max(img)
+    img = 255.0 * (img - u) / (v - u)
+    return img
+
+# bright spot cut for a projection's pixels: a sum projection adds up every page,
+# so the single page maxthresh is scaled by the number of pages
+def projection_thresh(maxthresh, projection, pages):
+    return maxthresh * pages if projection == "sum" else maxthresh
+
+# projection: which intensity projection of a multi-page tiff to analyze ("max", "sum" or "focus")
+# single page tiffs give the same image for every projection
+# flatfield: optional plate illumination model (see flatfield.py) applied before scaling
+def get_img(filename, maxthresh=17500, projection="max", flatfield=None):
+    projs = project_stack(filename, (projection,))
+    return normalize_img(projs[projection], projection_thresh(maxthresh, projection, projs["pages"]), flatfield)
 
 # determine if given file lines us with a desired image
 def valid_file(f, rows, cols, site):
@@ -77,20 +96,31 @@ def get_filenames(cur_path, pattern, site):
 # Get Data
 # ******************************************************************************
 
+# run fcn(*args, **kwargs) on the executor, or right away if there is none, returns a future
+def run_on(executor, fcn, *args, **kwargs):
+    if executor is not None:
+        return executor.submit(fcn, *args, **kwargs)
+    future = Future()
+    future.set_result(fcn(*args, **kwargs))
+    return future
+
 # Get nuclei centroids as coords
-def detect_nuclei(img_in, minthresh=25, searchlen=21, mincellsize=2, minpeak=0.2):
+# executor: optional thread pool, the independent filter stages (min/max filters, the two
+#           convolutions and the 2x2 max pool) then run concurrently, scipy releases the GIL in them
+def detect_nuclei(img_in, minthresh=25, searchlen=21, mincellsize=2, minpeak=0.2, executor=None):
     img = np.copy(img_in)
     img[img < minthresh] = 0
 
     # downsample the image to the factor based on accepted mincellsize
     multfactor = 2**(mincellsize - 1)
-    # block_reduce downsamples, it does not change the images shape
-    img = block_reduce(img, block_size=(multfactor, multfactor), func=np.mean)
+    # mean pooling downsamples by multfactor in each direction
+    img = mean_pool(img, multfactor)
 
     # expand mins and maxes
     ########### mess with the SIZE param, will impact accuracy but also speed
-    max_img = maximum_filter(img, size=3) # expand nuc centers
-    min_img = minimum_filter(img, size=3) # concentrate nuc centers
+    max_job = run_on(executor, ndimage.maximum_filter, img, size=3) # expand nuc centers
+    min_img = ndimage.minimum_filter(img, size=3) # concentrate nuc centers
+    max_img = max_job.result()
 
     # nuclei with "hollow" centers
     avoid = ((max_img + minthresh) - min_img) / (min_img + minthresh)
@@ -100,11 +130,13 @@ def detect_nuclei(img_in, minthresh=25, searchlen=21, mincellsize=2, minpeak=0.2
     x_grid, y_grid = np.mgrid[0:(2 * searchlen + 1), 0:(2 * searchlen + 1)]
     dist = np.sqrt(np.square(x_grid - searchlen) + np.square(y_grid - searchlen))
     krnl = searchlen / (1 + dist)
-    cellness = convolve(cellness, krnl, mode='constant')
-    avoid = convolve(avoid, krnl, mode='constant')
+    cellness_job = run_on(executor, ndimage.convolve, cellness, krnl, mode='constant')
+    pool_job = run_on(executor, max_pool, img, 2)
+    avoid = ndimage.convolve(avoid, krnl, mode='constant')
+    cellness = cellness_job.result()
     optfcn = cellness/(avoid+0.1)
 
-    img = block_reduce(img, block_size=(2,2), func=np.max)
+    img = pool_job.result()
     nuc_pts = []
     selected = np.zeros_like(optfcn)
     visited = np.zeros_like(optfcn)
@@ -146,34 +178,45 @@ def detect_nuclei(img_in, minthresh=25, searchlen=21, mincellsize=2, minpeak=0.2
 
     return np.array(nuc_pts)
 
+# Default 10x parameters
+DEFAULT_PARAMS = {
+    'minthresh': 25, # threshold to eliminate noise from actual nuclei (smaller = more sensitive to noise / nuclei)
+    #'maxthresh': 17500, # threshold to eliminate bright spots from actual nuclei (smaller = more sensitive to bright spots in scaling)
+    'searchlen': 3,  # controls the filter that highlights nuceli centers (bigger = wider gradients to make one peak/nucleus, but more likelihood of merged nuclei)
+    'mincellsize': 2,  # controls number of downsamples - will tend to remove smaller "nuclei"
+    'minpeak': 0.02  # minimum allowed value of optimization function - higher values reject noise but may lose low intensity nuclei
+}
+
 # Wrapper for detect nuclei on 10x images
-def get_nuc_centers(img, params=None):
+def get_nuc_centers(img, params=None, executor=None):
     if not params:
-        # Default 10x parameters
-        params = {
-            'minthresh': 25, # threshold to eliminate noise from actual nuclei (smaller = more sensitive to noise / nuclei)
-            #'maxthresh': 17500, # threshold to eliminate bright spots from actual nuclei (smaller = more sensitive to bright spots in scaling)
-            'searchlen': 3,  # controls the filter that highlights nuceli centers (bigger = wider gradients to make one peak/nucleus, but more likelihood of merged nuclei)
-            'mincellsize': 2,  # controls number of downsamples - will tend to remove smaller "nuclei"
-            'minpeak': 0.02  # minimum allowed value of optimization function - higher values reject noise but may lose low intensity nuclei
-        }
+        params = DEFAULT_PARAMS
     # Find nuclei centroids
     try:
-        nucpts = detect_nuclei(img, **params)
+        nucpts = detect_nuclei(img, **params, executor=executor)
     except:
         return None
     return nucpts
 
-# returns two dicts:
+# returns four dicts:
 #   1) well : well's nuclei points as a list
 #   2) well : number of detected nuclei
-def get_well_nuc_pairs(well_file_dict, maxthresh):
-    # dict mapping the name of the well and site of the image (key) 
-    # to its list of nuc centers (value)
-    images = dict(map(lambda x: (x[0], get_img(x[1], maxthresh)), well_file_dict.items() ))
-    nuc_list_d = dict(map(lambda x: (x[0], get_nuc_centers(x[1])), images.items() ))
-    nuc_count_d = dict(map(lambda x: (x[0], len(x[1])), nuc_list_d.items() ))
-    return (nuc_list_d, nuc_count_d)
+#   3) well : total intensity of the sum intensity projection
+#   4) well : maximum raw intensity
+# each file is read once, in one pass over its pages, and only kept until its nuclei are found
+# flatfield: optional plate illumination model, corrects the analyzed projection before detection
+def get_well_nuc_pairs(well_file_dict, maxthresh, projection="max", flatfield=None):
+    nuc_list_d, nuc_count_d, sum_ips_d, max_d = {}, {}, {}, {}
+    needed = tuple(dict.fromkeys(("sum", "max", projection)))
+    for well, filename in well_file_dict.items():
+        projs = project_stack(filename, needed)
+        thresh = projection_thresh(maxthresh, projection, projs["pages"])
+        nucpts = get_nuc_centers(normalize_img(projs[projection], thresh, flatfield))
+        nuc_list_d[well] = nucpts
+        nuc_count_d[well] = len(nucpts)
+        sum_ips_d[well] = float(np.sum(projs["sum"]))
+        max_d[well] = projs["max"].max()
+    return (nuc_list_d, nuc_count_d, sum_ips_d, max_d)
 
 # seperates the well tag from the well site string
 def get_well(s):
@@ -198,13 +241,10 @@ def calc_well_data(nucCount_d, pattern, site):
 
 # given an image's nuc list, get data regarding the maxes at those points
 def image_data_summary(img, nucpts):
-    f = lambda x: img[x[0], x[1]]
-    img_copy = np.copy(img)
-    peaks = f(nucpts)
-    max_peak = peaks.max()
-    min_peak = peaks.min()
+    peaks = img[nucpts[:, 0], nucpts[:, 1]]
     avg_peak = np.sum(peaks) / peaks.size
-    median_peak = np.sort(peaks)[peaks.size//2]
+    # only the middle element has to be in place, no need for a full sort
+    median_peak = np.partition(peaks, peaks.size//2)[peaks.size//2]
     return (peaks.max(), peaks.min(), avg_peak, median_peak, img.max(), img.min())
 
 
@@ -215,19 +255,19 @@ def image_data_summary(img, nucpts):
 #           - current concurrency through map is enough after investigating thread options
 #       - parallelism?
 
-def single_file_analysis(filename):
+def single_file_analysis(filename, projection="max", executor=None):
     if filename == "":
         showinfo(title='Error', message="No file selected")
         return None
 
-    img = get_img(filename)
-    nucpts = get_nuc_centers(img)
+    img = get_img(filename, projection=projection)
+    nucpts = get_nuc_centers(img, executor=executor)
     nuc_count = len(nucpts)
 
     return (filename, nucpts, nuc_count)
 
 
-def multi_file_analysis(dirname, pattern=0, maxthresh=17500, site=5):
+def multi_file_analysis(dirname, pattern=0, maxthresh=17500, site=5, projection="max", flatfield=False):
     if dirname == "": return None
 
     total_files = len([f for f in listdir(dirname) if path.isfile(path.join(dirname,f))])
@@ -239,7 +279,9 @@ def multi_file_analysis(dirname, pattern=0, maxthresh=17500, site=5):
         showinfo(title='Error', message="No files that match the selected search parameters")
         return None
 
-    (nucpts_d, nucCounts_d) = get_well_nuc_pairs(file_d, maxthresh)
+    # plate illumination model, estimated on the first run and cached in the plate directory
+    model = load_flatfield(dirname, file_d, site, projection) if flatfield else None
+    (nucpts_d, nucCounts_d, sum_ips_d, max_d) = get_well_nuc_pairs(file_d, maxthresh, projection, model)
     #well_est_d, well_avg = calc_well_data(nucCounts_d, pattern, site)
 
-    return (file_d, nucpts_d, nucCounts_d, total_files)
+    return (file_d, nucpts_d, nucCounts_d, total_files, sum_ips_d, max_d)
@@ -0,0 +1,106 @@
+# Nucleus Features
+# Per nucleus measurements seeded from the detected nuclei centers
+# Max Jantos
+#
+# Each foreground pixel (above minthresh after scaling, like detect_nuclei) is given to its
+# nearest nucleus center, up to max_radius away (a Voronoi limited threshold mask).
+# All features are then labelled array reductions (bincount), with no per nucleus loops.
+
+import numpy as np
+
+from lazy_import import lazy_module
+from nuclei_detection import normalize_img, projection_thresh
+from projection import project_stack
+
+ndimage = lazy_module("scipy.ndimage")
+spatial = lazy_module("scipy.spatial")
+
+
+# columns of a feature table, in order
+FEATURE_COLUMNS = ["well", "y", "x", "centroid_y", "centroid_x", "area", "integrated_intensity",
+                   "mean_intensity", "eccentricity", "nn_distance"]
+
+
+# ******************************************************************************
+# Single image
+# ******************************************************************************
+
+# Label image: pixel value i is the i-th nucleus of nucpts (1 based), 0 is background
+def nucleus_labels(scaled_img, nucpts, minthresh=25, max_radius=10):
+    labels = np.zeros(scaled_img.shape, dtype=np.int32)
+    if len(nucpts) == 0: return labels
+    labels[nucpts[:, 0], nucpts[:, 1]] = np.arange(1, len(nucpts) + 1)
+    # distance to, and index of, the nearest center for every pixel
+    dist, (iy, ix) = ndimage.distance_transform_edt(labels == 0, return_indices=True)
+    labels = labels[iy, ix]
+    labels[(scaled_img < minthresh) | (dist > max_radius)] = 0
+    return labels
+
+# distance from each center to its nearest neighbour (NaN when there is only one)
+def nearest_neighbour_distance(nucpts):
+    if len(nucpts) < 2: return np.full(len(nucpts), np.nan)
+    dist, _ = spatial.cKDTree(nucpts).query(nucpts, k=2)
+    return dist[:, 1]
+
+# Features of every nucleus of one image, as a dict of column arrays (without "well")
+# intensities are measured on the raw image, the mask comes from the scaled image
+# maxthresh and flatfield must be the bright spot cut and illumination model detection used on the image
+# (projection_thresh scales the cut for a sum projection)
+def image_features(raw_img, nucpts, maxthresh=17500, minthresh=25, max_radius=10, flatfield=None):
+    nucpts = np.asarray(nucpts, dtype=np.intp).reshape(-1, 2)
+    n = len(nucpts)
+    labels = nucleus_labels(normalize_img(raw_img, maxthresh, flatfield), nucpts, minthresh, max_radius)
+
+    # only foreground pixels take part in the reductions
+    fg = np.flatnonzero(labels)
+    lbl = labels.ravel()[fg]
+    y, x = np.divmod(fg, labels.shape[1])
+    y = y.astype(np.float64)
+    x = x.astype(np.float64)
+    values = raw_img.ravel()[fg].astype(np.float64)
+
+    def per_nucleus(weights=None):
+        return np.bincount(lbl, weights=weights, minlength=n + 1)[1:]
+
+    area = per_nucleus()
+    integrated = per_nucleus(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_intensity = integrated / area
+        cy = per_nucleus(y) / area
+        cx = per_nucleus(x) / area
+        # second central moments -> eigenvalues of the covariance -> eccentricity
+        cov_yy = per_nucleus(y * y) / area - cy**2
+        cov_xx = per_nucleus(x * x) / area - cx**2
+        cov_xy = per_nucleus(x * y) / area - cx * cy
+        half_trace = (cov_yy + cov_xx) / 2
+        root = np.sqrt(np.maximum(half_trace**2 - (cov_yy * cov_xx - cov_xy**2), 0))
+        major, minor = half_trace + root, half_trace - root
+        eccentricity = np.where(major > 0, np.sqrt(np.clip(1 - minor / major, 0, 1)), 0.0)
+
+    return {"y": nucpts[:, 0], "x": nucpts[:, 1], "centroid_y": cy, "centroid_x": cx,
+            "area": area.astype(np.int64), "integrated_intensity": integrated,
+            "mean_intensity": mean_intensity, "eccentricity": eccentricity,
+            "nn_distance": nearest_neighbour_distance(nucpts)}
+
+
+# ******************************************************************************
+# Plate
+# ******************************************************************************
+
+# Columnar feature table of every analyzed image of a plate, one row per nucleus
+# returns dict of FEATURE_COLUMNS : array, with "well" holding the well tag with site
+# flatfield: the plate illumination model the plate was analyzed with, if any
+def plate_feature_table(plate, maxthresh=17500, projection="max", minthresh=25, max_radius=10, flatfield=None):
+    tables = []
+    for tag in plate.tags():
+        idx = plate.index(tag)
+        nucpts = plate.nucpts[idx]
+        if len(nucpts) == 0: continue
+        projs = project_stack(plate.files[idx], (projection,))
+        thresh = projection_thresh(maxthresh, projection, projs["pages"])
+        table = image_features(projs[projection], nucpts, thresh, minthresh, max_radius, flatfield)
+        table["well"] = np.full(len(nucpts), tag, dtype=object)
+        tables.append(table)
+    if not tables:
+        return {c: np.array([]) for c in FEATURE_COLUMNS}
+    return {c: np.concatenate([t[c] for t in tables]) for c in FEATURE_COLUMNS}
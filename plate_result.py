@@ -0,0 +1,208 @@
+# Plate Result
+# Array backed results for one plate, indexed by (row, col, site)
+# Replaces the parallel "C17 s5" keyed dicts so flagging and plate statistics
+# are whole array operations
+# Max Jantos
+
+import re
+
+import numpy as np
+
+from lazy_import import lazy_module
+
+tf = lazy_module("tifffile")
+
+
+# plate formats supported by the row labelling, as (rows, cols)
+PLATE_SHAPES = {96: (8, 12), 384: (16, 24), 1536: (32, 48)}
+MAX_SITES = 9
+
+# flag bits stored in PlateResult.flags
+FLAG_LOW_COUNT = 1
+FLAG_BRIGHT = 2
+
+WELL_TAG = re.compile(r"^([A-Z]+)(\d+)(?: s(\d+))?$")
+
+
+# ******************************************************************************
+# Well tags
+# ******************************************************************************
+
+# 0 -> A, 25 -> Z, 26 -> AA, ... (1536 well plates go up to AF)
+def row_label(r):
+    if r < 26: return chr(ord('A') + r)
+    return row_label(r // 26 - 1) + chr(ord('A') + r % 26)
+
+def row_index(label):
+    r = 0
+    for ch in label:
+        r = 26 * r + (ord(ch) - ord('A') + 1)
+    return r - 1
+
+# "C17 s5" -> (2, 16, 4), "C17" -> (2, 16, None)
+def parse_well_tag(tag):
+    m = WELL_TAG.match(tag)
+    if m is None: raise ValueError(f"Not a well tag: {tag}")
+    site = None if m.group(3) is None else int(m.group(3)) - 1
+    return (row_index(m.group(1)), int(m.group(2)) - 1, site)
+
+# (2, 16, 4) -> "C17 s5", (2, 16) -> "C17"
+def well_tag(r, c, s=None):
+    if s is None: return f"{row_label(r)}{c + 1}"
+    return f"{row_label(r)}{c + 1} s{s + 1}"
+
+
+# ******************************************************************************
+# Plate Result
+# ******************************************************************************
+class PlateResult:
+    def __init__(self, shape=(16, 24), n_sites=MAX_SITES, dirname=None, total_files=0):
+        full_shape = tuple(shape) + (n_sites,)
+        self.dirname = dirname
+        self.total_files = total_files
+        self.counts = np.full(full_shape, -1, dtype=np.int32)       # number of nuclei detected, -1 means not analyzed
+        self.max_intensity = np.zeros(full_shape, dtype=np.float64) # raw image maximum
+        self.sum_intensity = np.zeros(full_shape, dtype=np.float64) # raw image total intensity
+        self.flags = np.zeros(full_shape, dtype=np.uint8)           # FLAG_* bits, set by update_flags
+        self.files = np.full(full_shape, "", dtype=object)          # image's filepath
+        self.nucpts = np.full(full_shape, None, dtype=object)       # nucpt coordinates as an (n, 2) array
+
+    @property
+    def shape(self):
+        return self.counts.shape
+
+    # boolean mask of the analyzed (row, col, site) entries
+    @property
+    def analyzed(self):
+        return self.counts >= 0
+
+    # Build a plate from the dicts multi_file_analysis returns
+    # raw images are read once here for their max/sum intensity unless sum_ips_d/max_d are given
+    @classmethod
+    def from_dicts(cls, file_d, nucpts_d, shape=(16, 24), dirname=None, total_files=0,
+                   max_d=None, sum_ips_d=None):
+        plate = cls(shape, dirname=dirname, total_files=total_files)
+        for tag, filename in file_d.items():
+            nucpts = nucpts_d.get(tag)
+            if nucpts is None: continue
+            if max_d is None or sum_ips_d is None:
+                raw_img = tf.imread(filename)
+                max_intensity, sum_intensity = raw_img.max(), np.sum(raw_img, dtype=np.float64)
+            if max_d is not None: max_intensity = max_d[tag]
+            if sum_ips_d is not None: sum_intensity = sum_ips_d[tag]
+            plate.set_site(tag, filename, nucpts, max_intensity, sum_intensity)
+        return plate
+
+    def set_site(self, tag, filename, nucpts, max_intensity, sum_intensity):
+        idx = self.index(tag)
+        self.files[idx] = filename
+        self.nucpts[idx] = nucpts
+        self.counts[idx] = len(nucpts)
+        self.max_intensity[idx] = max_intensity
+        self.sum_intensity[idx] = sum_intensity
+
+    # (row, col, site) index of a "C17 s5" tag
+    def index(self, tag):
+        r, c, s = parse_well_tag(tag)
+        if s is None: raise ValueError(f"Well tag has no site: {tag}")
+        return (r, c, s)
+
+    # tags of every analyzed entry, in plate order (row, then col, then site)
+    def tags(self):
+        return [well_tag(r, c, s) for r, c, s in zip(*np.nonzero(self.analyzed))]
+
+    # Back to the string keyed dicts (file_d, nucpts_d, nucCounts_d)
+    def to_dicts(self):
+        idx = list(zip(*np.nonzero(self.analyzed)))
+        file_d = {well_tag(*i): self.files[i] for i in idx}
+        nucpts_d = {well_tag(*i): self.nucpts[i] for i in idx}
+        nucCounts_d = {well_tag(*i): int(self.counts[i]) for i in idx}
+        return (file_d, nucpts_d, nucCounts_d)
+
+    # **************************************************************************
+    # Flags and statistics
+    # **************************************************************************
+
+    # Recompute the flags of every analyzed entry for the given thresholds
+    def update_flags(self, count_thresh, ceiling_thresh):
+        analyzed = self.analyzed
+        self.flags = (np.where(analyzed & (self.counts < count_thresh), FLAG_LOW_COUNT, 0) |
+                      np.where(analyzed & (self.max_intensity > ceiling_thresh), FLAG_BRIGHT, 0)).astype(np.uint8)
+        return self.flags
+
+    # Returns (min tag, min count, max tag, max count, mean count) over every analyzed entry,
+    # or None if nothing has been analyzed
+    def count_stats(self):
+        analyzed = self.analyzed
+        if not analyzed.any(): return None
+        flat_idx = np.flatnonzero(analyzed)
+        counts = self.counts.ravel()[flat_idx]
+        min_tag = well_tag(*np.unravel_index(flat_idx[np.argmin(counts)], self.shape))
+        max_tag = well_tag(*np.unravel_index(flat_idx[np.argmax(counts)], self.shape))
+        return (min_tag, int(counts.min()), max_tag, int(counts.max()), counts.mean())
+
+    # count statistics reduced over the given axes, unanalyzed entries ignored
+    # returns dict of arrays: n, mean, std, min, max (NaN where nothing was analyzed)
+    def axis_stats(self, axis):
+        analyzed = self.analyzed
+        counts = self.counts.astype(np.float64)
+        n = analyzed.sum(axis=axis)
+        total = np.where(analyzed, counts, 0).sum(axis=axis)
+        total_sq = np.where(analyzed, counts**2, 0).sum(axis=axis)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, total / n, np.nan)
+            std = np.sqrt(np.maximum(np.where(n > 0, total_sq / n, np.nan) - mean**2, 0))
+        return {"n": n, "mean": mean, "std": std,
+                "min": np.where(n > 0, np.where(analyzed, counts, np.inf).min(axis=axis), np.nan),
+                "max": np.where(n > 0, np.where(analyzed, counts, -np.inf).max(axis=axis), np.nan)}
+
+    # per row statistics (arrays of length rows)
+    def row_stats(self):
+        return self.axis_stats((1, 2))
+
+    # per column statistics (arrays of length cols)
+    def col_stats(self):
+        return self.axis_stats((0, 2))
+
+    # per well statistics over its sites (arrays of shape (rows, cols))
+    def well_stats(self):
+        return self.axis_stats(2)
+
+    # Boolean mask of analyzed entries whose count is an outlier for the plate
+    # uses a robust z score (median / median absolute deviation) so a few empty wells
+    # do not hide each other
+    def outliers(self, z_thresh=3.5):
+        analyzed = self.analyzed
+        if not analyzed.any(): return analyzed
+        counts = self.counts[analyzed].astype(np.float64)
+        median = np.median(counts)
+        mad = 1.4826 * np.median(np.abs(counts - median))
+        if mad == 0: return np.zeros_like(analyzed)
+        z = (self.counts - median) / mad
+        return analyzed & (np.abs(z) > z_thresh)
+
+
+# ******************************************************************************
+# Multi-plate comparison
+# ******************************************************************************
+
+# Stack the counts of plates with the same layout into a (plates, rows, cols, sites)
+# float array with NaN for unanalyzed entries
+def stack_counts(plates):
+    return np.stack([np.where(p.analyzed, p.counts, np.nan) for p in plates])
+
+# Compare plates of the same layout entry by entry
+# returns dict of (rows, cols, sites) arrays: n, mean, std and cv (std / mean) across plates,
+# plus "plate_median": the median count of each plate
+def compare_plates(plates):
+    counts = stack_counts(plates)
+    valid = ~np.isnan(counts)
+    n = valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = np.where(valid, counts, 0).sum(axis=0)
+        mean = np.where(n > 0, total / n, np.nan)
+        var = np.where(valid, (counts - mean)**2, 0).sum(axis=0)
+        std = np.where(n > 0, np.sqrt(var / n), np.nan)
+        cv = std / mean
+    plate_median = np.array([np.median(p.counts[p.analyzed]) if p.analyzed.any() else np.nan for p in plates])
+    return {"n": n, "mean": mean, "std": std, "cv": cv, "plate_median": plate_median}
@@ -0,0 +1,28 @@
+# Pooling
+# Block mean / max pooling done with reshapes instead of skimage's block_reduce
+# Edges are padded the same way block_reduce pads them (with zeros at the end of each axis)
+# Max Jantos
+
+import numpy as np
+
+
+# pad the bottom and right edges with cval so both sides are a multiple of block
+def pad_to_blocks(img, block, cval=0):
+    pad_r = -img.shape[0] % block
+    pad_c = -img.shape[1] % block
+    if pad_r == 0 and pad_c == 0: return img
+    return np.pad(img, ((0, pad_r), (0, pad_c)), mode='constant', constant_values=cval)
+
+# (h, w) -> (h/block, w/block, block, block) view, the same layout block_reduce reduces over
+def block_view(img, block):
+    img = pad_to_blocks(img, block)
+    h, w = img.shape
+    return img.reshape(h // block, block, w // block, block).transpose(0, 2, 1, 3)
+
+# same result as block_reduce(img, block_size=(block, block), func=np.mean)
+def mean_pool(img, block):
+    return block_view(img, block).mean(axis=(2, 3))
+
+# same result as block_reduce(img, block_size=(block, block), func=np.max)
+def max_pool(img, block):
+    return block_view(img, block).max(axis=(2, 3))
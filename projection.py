@@ -0,0 +1,68 @@
+# Intensity Projections
+# Streams multi-page tiff z-stacks / time series one page at a time and
+# accumulates sum, max and best focus projections in a single pass
+# Max Jantos
+
+import numpy as np
+
+from lazy_import import lazy_module
+
+ndimage = lazy_module("scipy.ndimage")
+tf = lazy_module("tifffile")
+
+
+# sum   - sum intensity projection (float64)
+# max   - maximum intensity projection (image's own dtype)
+# focus - the single sharpest page of the stack
+PROJECTIONS = ("sum", "max", "focus")
+
+
+# focus score of one page: variance of its laplacian, higher means sharper
+def focus_score(plane):
+    return np.var(ndimage.laplace(plane.astype(np.float32)))
+
+# yields the 2D planes of a tiff, one page at a time
+# pages that hold more than one plane (i.e. several samples) are split up,
+# contiguous samples (H, W, S) are moved in front first so each plane is a whole (H, W) image
+def iter_planes(tif):
+    for page in tif.pages:
+        data = page.asarray()
+        if data.ndim == 2:
+            yield data
+        else:
+            if page.samplesperpixel > 1 and page.planarconfig == tf.PLANARCONFIG.CONTIG:
+                data = np.moveaxis(data, -1, 0)
+            for plane in data.reshape(-1, *data.shape[-2:]):
+                yield plane
+
+# Read the tiff page by page and accumulate the requested projections
+# memory use stays at a few planes no matter how many pages the stack has
+# returns dict of projection name : 2D array, plus "pages" : number of planes read
+# a single page tiff gives the image itself for "max" and "focus"
+def project_stack(filename, projections=PROJECTIONS):
+    for p in projections:
+        if p not in PROJECTIONS: raise ValueError(f"Unknown projection: {p}")
+
+    sum_ip = None
+    max_ip = None
+    focus_ip, best_focus = None, -np.inf
+    n = 0
+    with tf.TiffFile(filename) as tif:
+        for plane in iter_planes(tif):
+            if n == 0:
+                if "sum" in projections: sum_ip = plane.astype(np.float64)
+                if "max" in projections: max_ip = plane.copy()
+            else:
+                if "sum" in projections: sum_ip += plane
+                if "max" in projections: np.maximum(max_ip, plane, out=max_ip)
+            if "focus" in projections:
+                score = focus_score(plane)
+                if score > best_focus:
+                    focus_ip, best_focus = plane, score
+            n += 1
+
+    if n == 0: raise ValueError(f"No image data in {filename}")
+    projs = {"sum": sum_ip, "max": max_ip, "focus": focus_ip}
+    projs = {p: projs[p] for p in projections}
+    projs["pages"] = n
+    return projs
@@ -0,0 +1,193 @@
+# Quick QC
+# Approximate plate QC from decimated images, refined at full resolution in the background
+# Max Jantos
+#
+# The preview keeps every k-th row and column of each image (from a memory map or a
+# reduced resolution tiff level when the file has one, so most of the image is never decoded)
+# and rescales the detection parameters to match. Wells are then re-analyzed at full resolution,
+# worst flagged first, while the approximate results are already on screen.
+
+import threading
+from math import log2
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from lazy_import import lazy_module
+from nuclei_detection import normalize_img, projection_thresh, get_nuc_centers, DEFAULT_PARAMS
+from plate_result import PlateResult, FLAG_LOW_COUNT, FLAG_BRIGHT
+from projection import project_stack
+
+tf = lazy_module("tifffile")
+
+
+# ******************************************************************************
+# Decimated detection
+# ******************************************************************************
+
+# Returns every k-th row and column of a single page tiff
+# reads from a memory map or a reduced resolution level when possible,
+# otherwise falls back to a full read of the max projection
+def read_decimated(filename, k):
+    try:
+        img = tf.memmap(filename, mode='r')
+        if img.ndim == 2:
+            return np.array(img[::k, ::k])
+    except (ValueError, OSError):
+        pass # compressed or not contiguous, can't be memory mapped
+
+    with tf.TiffFile(filename) as tif:
+        series = tif.series[0]
+        # pick the smallest pyramid level that still has at least 1/k of the full resolution
+        full_width = series.shape[-1]
+        best, best_factor = None, 1
+        for level in series.levels[1:]:
+            factor = full_width // level.shape[-1]
+            if best_factor < factor <= k and level.ndim == 2:
+                best, best_factor = level, factor
+        if best is not None:
+            step = max(1, k // best_factor)
+            return best.asarray()[::step, ::step]
+
+    return project_stack(filename, ("max",))["max"][::k, ::k]
+
+# Largest decimation a preview can use with the given detection parameters
+# decimation only stands in for the mean pooling detect_nuclei would have done (mincellsize),
+# past that its 3x3 filters span more raw pixels than they were tuned for and most nuclei are lost
+def max_preview_factor(params=None):
+    return 2**((params or DEFAULT_PARAMS)['mincellsize'] - 1)
+
+# Scale the detection parameters for an image decimated by k (at most max_preview_factor)
+def decimated_params(params, k):
+    params = dict(params)
+    multfactor = max_preview_factor(params)
+    if k > multfactor: raise ValueError(f"Decimation {k} is larger than the detection's own pooling ({multfactor})")
+    params['mincellsize'] = int(log2(multfactor // k)) + 1
+    return params
+
+# Nuclei centers of an image already decimated by k, in full resolution coordinates
+# flatfield: optional illumination model of the decimated images (FlatField.decimated)
+def preview_nuc_centers(decimated_img, k, maxthresh=17500, params=None, flatfield=None):
+    img = normalize_img(decimated_img, maxthresh, flatfield)
+    nucpts = get_nuc_centers(img, decimated_params(params or DEFAULT_PARAMS, k))
+    if nucpts is None: return None
+    return k * nucpts.reshape(-1, 2)
+
+# Approximate nuclei centers and raw maximum of one image, in full resolution coordinates
+def preview_well(filename, maxthresh=17500, k=2, params=None, flatfield=None):
+    try:
+        raw_img = read_decimated(filename, k)
+    except Exception:
+        return (None, 0)
+    return (preview_nuc_centers(raw_img, k, maxthresh, params, flatfield), raw_img.max())
+
+# Full resolution nuclei centers, raw maximum and total intensity (of the sum projection) of one image
+# flatfield: optional plate illumination model (see flatfield.py)
+def refine_well(filename, maxthresh=17500, projection="max", flatfield=None):
+    projs = project_stack(filename, tuple(dict.fromkeys(("sum", "max", projection))))
+    img = normalize_img(projs[projection], projection_thresh(maxthresh, projection, projs["pages"]), flatfield)
+    return (get_nuc_centers(img), projs["max"].max(), float(np.sum(projs["sum"])))
+
+
+# ******************************************************************************
+# Progressive QC
+# ******************************************************************************
+class ProgressiveQC:
+    def __init__(self, file_d, maxthresh=17500, count_thresh=2000, ceiling_thresh=17500,
+                 factor=None, projection="max", max_workers=None, flatfield=None):
+        self.file_d = file_d                # well tag with site : image's filepath
+        self.maxthresh = maxthresh
+        self.count_thresh = count_thresh
+        self.ceiling_thresh = ceiling_thresh
+        # decimation of the preview images, capped so the preview still finds the nuclei
+        self.factor = max_preview_factor() if factor is None else min(factor, max_preview_factor())
+        self.projection = projection        # projection refined at full resolution, previews always use max
+        self.max_workers = max_workers
+        self.flatfield = flatfield          # optional plate illumination model, corrects previews and refines
+
+        self.lock = threading.Lock()
+        self.nucpts_d = {}                  # well tag with site : latest nucpts (approximate until refined)
+        self.max_d = {}                     # well tag with site : latest raw maximum
+        self.refined = set()                # wells that have their full resolution result
+        self.new_refined = []               # refined wells not yet handed out by pop_refined
+        self.pool = None
+        self.stopped = False
+
+    # Decimated analysis of every well, returns (nucpts_d, nucCounts_d, max_d)
+    def preview(self):
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            wells = list(self.file_d.keys())
+            preview_model = None if self.flatfield is None else self.flatfield.decimated(self.factor)
+            results = pool.map(preview_well, [self.file_d[w] for w in wells],
+                               [self.maxthresh] * len(wells), [self.factor] * len(wells),
+                               [None] * len(wells), [preview_model] * len(wells))
+            for well, (nucpts, max_value) in zip(wells, results):
+                if nucpts is None: continue
+                self.nucpts_d[well] = nucpts
+                self.max_d[well] = max_value
+        nucCounts_d = {w: len(pts) for w, pts in self.nucpts_d.items()}
+        return (dict(self.nucpts_d), nucCounts_d, dict(self.max_d))
+
+    # Wells in refinement order: both flags, then low count, then bright spots, then unflagged,
+    # lowest counts first within each group
+    def refine_order(self):
+        def severity(well):
+            count, max_value = len(self.nucpts_d[well]), self.max_d[well]
+            flags = (FLAG_LOW_COUNT if count < self.count_thresh else 0) | \
+                    (FLAG_BRIGHT if max_value > self.ceiling_thresh else 0)
+            rank = {FLAG_LOW_COUNT | FLAG_BRIGHT: 0, FLAG_LOW_COUNT: 1, FLAG_BRIGHT: 2, 0: 3}[flags]
+            return (rank, count)
+        return sorted(self.nucpts_d.keys(), key=severity)
+
+    # Start full resolution analysis of every previewed well in the background
+    def refine(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        # futures are picked up by the pool in submission order, so the worst wells go first
+        for well in self.refine_order():
+            future = self.pool.submit(refine_well, self.file_d[well], self.maxthresh, self.projection,
+                                      self.flatfield)
+            future.add_done_callback(lambda f, well=well: self.finish_well(well, f))
+
+    def finish_well(self, well, future):
+        # refines already running when the run was stopped still finish, their results are dropped
+        if future.cancelled() or self.stopped: return
+        nucpts, max_value, sum_value = (None, 0, np.nan) if future.exception() else future.result()
+        with self.lock:
+            if nucpts is not None:
+                self.nucpts_d[well] = nucpts
+                self.max_d[well] = max_value
+            self.refined.add(well)
+            self.new_refined.append((well, nucpts, max_value, sum_value))
+            finished = len(self.refined) == len(self.nucpts_d)
+        # every well is refined, let the idle workers exit instead of waiting for the next QC
+        if finished: self.pool.shutdown(wait=False)
+
+    # Returns the (well, nucpts, max, total intensity) results refined since the last call
+    # nucpts is None when the full resolution analysis failed for that well
+    def pop_refined(self):
+        with self.lock:
+            new, self.new_refined = self.new_refined, []
+        return new
+
+    # number of wells refined so far, out of the number previewed
+    def progress(self):
+        with self.lock:
+            return (len(self.refined), len(self.nucpts_d))
+
+    def done(self):
+        (refined, total) = self.progress()
+        return self.stopped or refined == total
+
+    def stop(self):
+        self.stopped = True
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    # PlateResult of the current (partly approximate) results
+    # total intensity is only known once a well is refined, until then it is NaN
+    def to_plate(self, shape=(16, 24), dirname=None, total_files=0):
+        plate = PlateResult(shape, dirname=dirname, total_files=total_files)
+        with self.lock:
+            for well, nucpts in self.nucpts_d.items():
+                plate.set_site(well, self.file_d[well], nucpts, self.max_d[well], np.nan)
+        return plate
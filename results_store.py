@@ -0,0 +1,215 @@
+# Results Store
+# Local SQLite database of analysis results for queries across plates
+# Max Jantos
+#
+# Tables:
+#   plates - one row per analyzed plate directory (settings and when it was analyzed)
+#   sites  - one row per analyzed image: well, row/col/site, count, max and total intensity
+#   nuclei - optional per nucleus coordinates of each site
+#
+# Run from the command line:
+#   python results_store.py <db> --below 2000 --since 2026-09-01 --csv low_wells.csv
+
+import csv
+import sqlite3
+import argparse
+from datetime import datetime
+
+from plate_result import parse_well_tag, well_tag
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plates (
+    id INTEGER PRIMARY KEY,
+    dirname TEXT NOT NULL,
+    analyzed_at TEXT NOT NULL,
+    pattern INTEGER,
+    site INTEGER,
+    maxthresh REAL,
+    projection TEXT,
+    total_files INTEGER
+);
+CREATE TABLE IF NOT EXISTS sites (
+    id INTEGER PRIMARY KEY,
+    plate_id INTEGER NOT NULL REFERENCES plates(id),
+    well TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    col INTEGER NOT NULL,
+    site INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    max_intensity REAL,
+    sum_intensity REAL,
+    filename TEXT,
+    UNIQUE (plate_id, row, col, site)
+);
+CREATE TABLE IF NOT EXISTS nuclei (
+    site_id INTEGER NOT NULL REFERENCES sites(id),
+    y INTEGER NOT NULL,
+    x INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS plates_dirname ON plates (dirname);
+CREATE INDEX IF NOT EXISTS plates_analyzed_at ON plates (analyzed_at);
+CREATE INDEX IF NOT EXISTS sites_well ON sites (well, plate_id);
+CREATE INDEX IF NOT EXISTS sites_count ON sites (count);
+CREATE INDEX IF NOT EXISTS sites_max_intensity ON sites (max_intensity);
+CREATE INDEX IF NOT EXISTS sites_sum_intensity ON sites (sum_intensity);
+CREATE INDEX IF NOT EXISTS nuclei_site ON nuclei (site_id);
+"""
+
+# columns returned by query_sites
+SITE_COLUMNS = ["plate_id", "dirname", "analyzed_at", "well", "site", "count",
+                "max_intensity", "sum_intensity", "filename", "site_id"]
+
+
+class ResultsStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        # WAL lets the GUI query the store while a batch is writing to it
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # **************************************************************************
+    # Inserts
+    # **************************************************************************
+
+    # Record a new plate, returns its id
+    def add_plate(self, dirname, pattern=None, site=None, maxthresh=None, projection="max",
+                  total_files=0, analyzed_at=None):
+        if analyzed_at is None: analyzed_at = datetime.now().isoformat(timespec='seconds')
+        with self.conn:
+            cur = self.conn.execute(
+                "INSERT INTO plates (dirname, analyzed_at, pattern, site, maxthresh, projection, total_files) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (dirname, analyzed_at, pattern, site, maxthresh, projection, total_files))
+        return cur.lastrowid
+
+    # Insert the sites of one well in a single transaction
+    # sites: list of (tag, filename, nucpts, max_intensity, sum_intensity), tag like "C17 s5"
+    # a site that is already stored for the plate is replaced, so rerunning a well is safe
+    def add_well(self, plate_id, sites, store_nuclei=True):
+        with self.conn:
+            for tag, filename, nucpts, max_intensity, sum_intensity in sites:
+                r, c, s = parse_well_tag(tag)
+                old = self.conn.execute("SELECT id FROM sites WHERE plate_id = ? AND row = ? AND col = ? AND site = ?",
+                                        (plate_id, r, c, s + 1)).fetchone()
+                if old is not None:
+                    self.conn.execute("DELETE FROM nuclei WHERE site_id = ?", old)
+                    self.conn.execute("DELETE FROM sites WHERE id = ?", old)
+                cur = self.conn.execute(
+                    "INSERT INTO sites (plate_id, well, row, col, site, count, max_intensity, sum_intensity, filename) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (plate_id, well_tag(r, c), r, c, s + 1, len(nucpts),
+                     None if max_intensity is None else float(max_intensity),
+                     None if sum_intensity is None else float(sum_intensity), filename))
+                if store_nuclei and len(nucpts) > 0:
+                    site_id = cur.lastrowid
+                    self.conn.executemany("INSERT INTO nuclei (site_id, y, x) VALUES (?, ?, ?)",
+                                          ((site_id, int(y), int(x)) for y, x in nucpts))
+
+    # Store a whole PlateResult, one transaction per well
+    def add_plate_result(self, plate, pattern=None, site=None, maxthresh=None, projection="max",
+                         store_nuclei=True):
+        plate_id = self.add_plate(plate.dirname, pattern, site, maxthresh, projection, plate.total_files)
+        wells = {}
+        for tag in plate.tags():
+            idx = plate.index(tag)
+            wells.setdefault(idx[:2], []).append((tag, plate.files[idx], plate.nucpts[idx],
+                                                  plate.max_intensity[idx], plate.sum_intensity[idx]))
+        for sites in wells.values():
+            self.add_well(plate_id, sites, store_nuclei)
+        return plate_id
+
+    # **************************************************************************
+    # Queries
+    # **************************************************************************
+
+    # Run any query, returns (column names, rows)
+    def query(self, sql, params=()):
+        cur = self.conn.execute(sql, params)
+        return ([d[0] for d in cur.description], cur.fetchall())
+
+    # Builds the query behind query_sites, returns (sql, params)
+    def sites_sql(self, dirname=None, well=None, since=None, until=None, min_count=None, max_count=None,
+                  min_intensity=None, max_intensity=None):
+        conditions, params = [], []
+        for clause, value in (("p.dirname = ?", dirname), ("s.well = ?", well),
+                              ("p.analyzed_at >= ?", since), ("p.analyzed_at < ?", until),
+                              ("s.count >= ?", min_count), ("s.count < ?", max_count),
+                              ("s.max_intensity >= ?", min_intensity), ("s.max_intensity < ?", max_intensity)):
+            if value is not None:
+                conditions.append(clause)
+                params.append(value)
+        sql = ("SELECT p.id AS plate_id, p.dirname, p.analyzed_at, s.well, s.site, s.count, s.max_intensity, "
+               "s.sum_intensity, s.filename, s.id AS site_id FROM sites s JOIN plates p ON p.id = s.plate_id")
+        if conditions: sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY p.analyzed_at, p.id, s.row, s.col, s.site"
+        return (sql, params)
+
+    # Sites matching every given filter, rows in SITE_COLUMNS order
+    # since/until are ISO dates or datetimes ("2026-09-01"), counts and intensities are
+    # lower bounds (min_*, inclusive) and upper bounds (max_*, exclusive)
+    def query_sites(self, **filters):
+        sql, params = self.sites_sql(**filters)
+        return self.query(sql, params)[1]
+
+    # Sites whose count was below count_thresh, i.e. "which wells were below threshold last month"
+    def sites_below(self, count_thresh, since=None, until=None, dirname=None):
+        return self.query_sites(max_count=count_thresh, since=since, until=until, dirname=dirname)
+
+    # Per nucleus coordinates of one stored site as (y, x) rows
+    def nuclei_of(self, site_id):
+        return self.query("SELECT y, x FROM nuclei WHERE site_id = ?", (site_id,))[1]
+
+    # Write the result of any query straight to a csv file
+    # rows are streamed from the cursor, so large results are never held in memory
+    def export_csv(self, filepath, sql, params=()):
+        if filepath.endswith('.csv') == False:
+            filepath = filepath + ".csv"
+        cur = self.conn.execute(sql, params)
+        with open(filepath, 'w', encoding='UTF8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([d[0] for d in cur.description])
+            writer.writerows(cur)
+        return filepath
+
+    # export_csv for the same filters query_sites takes
+    def export_sites_csv(self, filepath, **filters):
+        sql, params = self.sites_sql(**filters)
+        return self.export_csv(filepath, sql, params)
+
+
+# ******************************************************************************
+# Main
+# ******************************************************************************
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the results store")
+    parser.add_argument("db", help="results store database file")
+    parser.add_argument("--dirname", help="only this plate directory")
+    parser.add_argument("--well", help="only this well, i.e. C17")
+    parser.add_argument("--since", help="plates analyzed on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--until", help="plates analyzed before this date (YYYY-MM-DD)")
+    parser.add_argument("--below", type=int, help="sites with a count below this threshold")
+    parser.add_argument("--brighter", type=float, help="sites with a maximum intensity of at least this value")
+    parser.add_argument("--csv", help="write the matching sites to this csv file instead of printing them")
+    args = parser.parse_args()
+
+    filters = {"dirname": args.dirname, "well": args.well, "since": args.since, "until": args.until,
+               "max_count": args.below, "min_intensity": args.brighter}
+    with ResultsStore(args.db) as store:
+        if args.csv:
+            print(f"Wrote {store.export_sites_csv(args.csv, **filters)}")
+        else:
+            print(",".join(SITE_COLUMNS))
+            for row in store.query_sites(**filters):
+                print(",".join(str(v) for v in row))
@@ -0,0 +1,64 @@
+# Detection Harness Tests
+# Runs the detection harness's synthetic cases against every registered engine
+# Max Jantos
+#
+# Run with:
+#   python -m pytest
+
+import numpy as np
+import pytest
+
+from detection_harness import (ENGINES, synthetic_cases, run_harness, case_passes, match_points,
+                               check_pooling_kernels, naive_pool)
+from nuclei_detection import DEFAULT_PARAMS
+from pooling import mean_pool, max_pool
+from qc_preview import decimated_params, max_preview_factor
+
+
+# engine : (count_tol, min_match, distance tol in pixels)
+# engines that should give the reference result exactly are held to it, the preview
+# detects on every 2nd row and column (max_preview_factor) so its centers land a few pixels off
+TOLERANCES = {
+    "reference": (0.0, 1.0, 3.0),
+    "threaded": (0.0, 1.0, 3.0),
+    "preview": (0.2, 0.7, 6.0),
+}
+EXACT = (0.0, 1.0, 3.0)     # engines registered without an entry above
+
+SYNTHETIC_CASES = 3
+
+
+@pytest.mark.parametrize("engine_name", sorted(ENGINES.keys()))
+def test_engine_matches_reference(engine_name):
+    (count_tol, min_match, tol) = TOLERANCES.get(engine_name, EXACT)
+    rows = run_harness(engine_name, synthetic_cases(SYNTHETIC_CASES), tol=tol)
+    assert len(rows) == SYNTHETIC_CASES
+    for row in rows:
+        assert row["reference"] > 0, row
+        assert case_passes(row, count_tol, min_match), row
+
+
+def test_preview_decimation_is_capped():
+    with pytest.raises(ValueError):
+        decimated_params(DEFAULT_PARAMS, 2 * max_preview_factor())
+
+
+def test_match_points():
+    a = np.array([[10, 10], [20, 20], [30, 30]])
+    b = np.array([[11, 10], [20, 22], [60, 60]])
+    (matched, mean_dist) = match_points(a, b, tol=3.0)
+    assert matched == 2
+    assert mean_dist == pytest.approx(1.5)
+    assert match_points(a, np.zeros((0, 2)))[0] == 0
+
+
+@pytest.mark.parametrize("shape", [(64, 64), (61, 59), (37, 64), (5, 3), (1, 1)])
+@pytest.mark.parametrize("block", [1, 2, 3, 4, 8])
+def test_pooling_kernels(shape, block):
+    img = np.random.default_rng(0).uniform(0, 255, shape)
+    np.testing.assert_allclose(mean_pool(img, block), naive_pool(img, block, np.mean), rtol=1e-12, atol=0)
+    np.testing.assert_array_equal(max_pool(img, block), naive_pool(img, block, np.max))
+
+
+def test_check_pooling_kernels():
+    assert check_pooling_kernels() is True